@@ -13,6 +13,12 @@ let
   isNvidia = gpuType == "nvidia";
   isIntel = gpuType == "intel";
   isDesktop = !isLaptop;
+
+  # Hybrid graphics: NVIDIA dGPU offloading for an Intel/AMD iGPU
+  prime = config.cairn.hardware.prime;
+  isPrime = isNvidia && prime.enable;
+  primeIntel = isPrime && prime.intelBusId != "";
+  primeAmd = isPrime && prime.amdgpuBusId != "";
 in
 {
   # Options for GPU type and form factor (set by lib/default.nix hostModule)
@@ -50,6 +56,40 @@ in
       '';
     };
 
+    prime = {
+      enable = lib.mkOption {
+        type = lib.types.bool;
+        default = false;
+        description = ''
+          Hybrid graphics with PRIME render offload (requires gpuType = "nvidia").
+          The integrated GPU drives the display; applications run on the NVIDIA
+          GPU on demand with nvidia-offload, and the dGPU powers down when idle.
+          Set by the installer when it detects an Intel/AMD + NVIDIA laptop.
+        '';
+      };
+
+      nvidiaBusId = lib.mkOption {
+        type = lib.types.str;
+        default = "";
+        example = "PCI:1:0:0";
+        description = "PCI bus ID of the NVIDIA GPU (decimal, as shown by lspci converted from hex)";
+      };
+
+      intelBusId = lib.mkOption {
+        type = lib.types.str;
+        default = "";
+        example = "PCI:0:2:0";
+        description = "PCI bus ID of the Intel integrated GPU, if that is the iGPU";
+      };
+
+      amdgpuBusId = lib.mkOption {
+        type = lib.types.str;
+        default = "";
+        example = "PCI:5:0:0";
+        description = "PCI bus ID of the AMD integrated GPU, if that is the iGPU";
+      };
+    };
+
     enableGPURecovery = lib.mkOption {
       type = lib.types.bool;
       default = isAmd;
@@ -70,6 +110,14 @@ in
         assertion = !config.cairn.hardware.enableGPURecovery || isAmd;
         message = "cairn.hardware.enableGPURecovery can only be enabled with AMD GPUs (gpuType must be 'amd')";
       }
+      {
+        assertion = !prime.enable || isNvidia;
+        message = "cairn.hardware.prime requires an NVIDIA dGPU (gpuType must be 'nvidia')";
+      }
+      {
+        assertion = !isPrime || (prime.nvidiaBusId != "" && (primeIntel != primeAmd));
+        message = "cairn.hardware.prime needs nvidiaBusId and exactly one of intelBusId or amdgpuBusId";
+      }
     ];
 
     # === GPU / Graphics Hardware ===
@@ -84,7 +132,7 @@ in
             libva # VA-API
             vulkan-loader # Core Vulkan ICD loader
           ]
-          ++ lib.optionals isAmd [
+          ++ lib.optionals (isAmd || primeAmd) [
             mesa # OpenGL + RADV Vulkan for AMD
           ]
           ++ lib.optionals isNvidia [
@@ -93,7 +141,7 @@ in
             # These are additional libraries for Vulkan, CUDA, etc.
             nvidia-vaapi-driver # VA-API support for NVIDIA (for browser video acceleration)
           ]
-          ++ lib.optionals isIntel [
+          ++ lib.optionals (isIntel || primeIntel) [
             mesa # OpenGL + Intel Vulkan
             intel-media-driver # VA-API for Intel
           ];
@@ -128,22 +176,34 @@ in
         nvidiaSettings = true;
 
         # Power management (disabled by default to avoid suspend/resume issues)
-        # Enable only if experiencing corruption after sleep
-        powerManagement.enable = false;
-        # Fine-grained power management (experimental, Turing+ only)
-        powerManagement.finegrained = false;
+        # Enable only if experiencing corruption after sleep.
+        # With PRIME offload, the dGPU is runtime-suspended when idle
+        # (fine-grained power management, Turing+).
+        powerManagement.enable = isPrime;
+        powerManagement.finegrained = isPrime;
 
         # PRIME configuration (Optimus for laptops with hybrid graphics)
-        # Default to disabled on desktops with single discrete GPU
-        # For dual-GPU desktops (e.g., nvidia dGPU + AMD/Intel iGPU), configure manually:
+        # Offload is set up from cairn.hardware.prime; otherwise it is
+        # disabled by default on desktops with a single discrete GPU.
+        # For dual-GPU desktops driving displays from the dGPU, configure manually:
         #   hardware.nvidia.prime.sync.enable = true;
         #   hardware.nvidia.prime.nvidiaBusId = "PCI:X:Y:Z";
         #   hardware.nvidia.prime.amdgpuBusId = "PCI:A:B:C";  # or intelBusId
-        prime = lib.mkIf isDesktop {
-          offload.enable = lib.mkDefault false;
-          sync.enable = lib.mkDefault false;
-          reverseSync.enable = lib.mkDefault false;
-        };
+        prime =
+          if isPrime then
+            {
+              offload.enable = true;
+              offload.enableOffloadCmd = true; # nvidia-offload <app>
+              inherit (prime) nvidiaBusId;
+            }
+            // lib.optionalAttrs primeIntel { inherit (prime) intelBusId; }
+            // lib.optionalAttrs primeAmd { inherit (prime) amdgpuBusId; }
+          else
+            lib.mkIf isDesktop {
+              offload.enable = lib.mkDefault false;
+              sync.enable = lib.mkDefault false;
+              reverseSync.enable = lib.mkDefault false;
+            };
       };
     };
 
@@ -204,12 +264,15 @@ in
         # VA-API driver for hardware video decoding (mpv, browsers, etc.)
         LIBVA_DRIVER_NAME = "radeonsi";
       })
-      (lib.mkIf isNvidia {
+      (lib.mkIf (isNvidia && !isPrime) {
         # Backend for nvidia-vaapi-driver (direct = faster, egl = more compatible)
         NVD_BACKEND = "direct";
         # Workaround for Chromium/Electron apps to use correct VA-API driver
         LIBVA_DRIVER_NAME = "nvidia";
       })
+      # With PRIME offload, video decoding stays on the iGPU like everything else
+      (lib.mkIf primeIntel { LIBVA_DRIVER_NAME = "iHD"; })
+      (lib.mkIf primeAmd { LIBVA_DRIVER_NAME = "radeonsi"; })
     ];
   };
 }
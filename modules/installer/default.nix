@@ -42,10 +42,40 @@ let
     Icon=calamares
     X-GNOME-Autostart-enabled=true
   '';
+
+  # Every flake input source, including inputs of inputs, so the cairn job
+  # can lock and evaluate the target flake from the live store
+  collectInputs =
+    input: [ input.outPath ] ++ lib.concatMap collectInputs (lib.attrValues (input.inputs or { }));
+  flakeSources = lib.unique (lib.concatMap collectInputs (lib.attrValues inputs));
 in
 {
   options.cairn.installer = {
     enable = lib.mkEnableOption "Cairn graphical installer (Calamares)";
+
+    offline.enable = lib.mkOption {
+      type = lib.types.bool;
+      default = true;
+      description = ''
+        Ship the cairn flake's input sources on the ISO and record the
+        revision it was built from, so the installer can pin the target
+        flake to it and substitute from the live store instead of the
+        network (see installMode in the cairn job's cairn.conf).
+      '';
+    };
+
+    variantsIndex = lib.mkOption {
+      type = lib.types.nullOr lib.types.path;
+      default = null;
+      example = lib.literalExpression "./variants.json";
+      description = ''
+        Index of prebuilt configuration variants, written by the cairn job's
+        `main.py variants` command. The installer starts realising the
+        closure of the variant matching the user's choices while it
+        evaluates the real system. The toplevels must be in a binary cache
+        the installer uses.
+      '';
+    };
   };
 
   config = lib.mkIf cfg.enable {
@@ -196,5 +226,18 @@ in
 
     # Support all locales for the installer
     i18n.supportedLocales = [ "all" ];
+
+    # ── Offline install support ───────────────────────────────
+    system.extraDependencies = lib.mkIf cfg.offline.enable flakeSources;
+    environment.etc = lib.mkMerge [
+      (lib.mkIf (cfg.offline.enable && inputs.self ? rev) {
+        "cairn-installer/source.json".text = builtins.toJSON {
+          inherit (inputs.self) rev narHash lastModified;
+        };
+      })
+      (lib.mkIf (cfg.variantsIndex != null) {
+        "cairn-installer/variants.json".source = cfg.variantsIndex;
+      })
+    ];
   };
 }
@@ -29,6 +29,24 @@
         description = "Percentage of RAM to use for zram swap. Default: 25%";
       };
 
+      zramAlgorithm = lib.mkOption {
+        type = lib.types.str;
+        default = "zstd";
+        description = "zram compression algorithm. zstd compresses best; lz4 is faster when RAM is plentiful.";
+      };
+
+      tmpOnTmpfs = lib.mkOption {
+        type = lib.types.bool;
+        default = true;
+        description = "Mount /tmp as tmpfs (fewer SSD writes). Disable on low-RAM machines, where builds in /tmp compete with applications for memory.";
+      };
+
+      tmpfsSize = lib.mkOption {
+        type = lib.types.str;
+        default = "50%";
+        description = "Maximum size of the /tmp tmpfs, as a size or a percentage of RAM";
+      };
+
       enableNetworkOptimizations = lib.mkOption {
         type = lib.types.bool;
         default = true;
@@ -41,7 +59,10 @@
     # Boot configuration
     boot = {
       kernelPackages = pkgs.linuxPackages_latest;
-      tmp.useTmpfs = true; # fewer SSD writes
+      tmp = {
+        useTmpfs = config.cairn.system.performance.tmpOnTmpfs; # fewer SSD writes
+        tmpfsSize = config.cairn.system.performance.tmpfsSize;
+      };
 
       # Quiet boot
       kernelParams = [
@@ -106,7 +127,7 @@
     # Swap configuration
     zramSwap = {
       enable = true;
-      algorithm = "zstd";
+      algorithm = config.cairn.system.performance.zramAlgorithm;
       memoryPercent = config.cairn.system.performance.zramPercent;
     };
   };
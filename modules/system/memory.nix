@@ -11,6 +11,28 @@
           kills memory-hogging processes before the system becomes unresponsive.
         '';
       };
+
+      systemPressureLimit = lib.mkOption {
+        type = lib.types.str;
+        default = "80%";
+        description = "Memory pressure at which systemd-oomd acts on system.slice (system services).";
+      };
+
+      userPressureLimit = lib.mkOption {
+        type = lib.types.str;
+        default = "50%";
+        description = ''
+          Memory pressure at which systemd-oomd acts on user slices (browsers,
+          editors, builds started from a shell). Lower it on low-RAM machines
+          so runaway processes are killed before the desktop starts thrashing.
+        '';
+      };
+
+      rootPressureLimit = lib.mkOption {
+        type = lib.types.str;
+        default = "90%";
+        description = "Memory pressure at which systemd-oomd acts on the root slice (last resort).";
+      };
     };
   };
 
@@ -30,7 +52,7 @@
       "system.slice" = {
         sliceConfig = {
           ManagedOOMMemoryPressure = "kill";
-          ManagedOOMMemoryPressureLimit = "80%";
+          ManagedOOMMemoryPressureLimit = config.system.memory.oomd.systemPressureLimit;
         };
       };
 
@@ -38,7 +60,7 @@
       "user.slice" = {
         sliceConfig = {
           ManagedOOMMemoryPressure = "kill";
-          ManagedOOMMemoryPressureLimit = "50%";
+          ManagedOOMMemoryPressureLimit = config.system.memory.oomd.userPressureLimit;
         };
       };
 
@@ -46,7 +68,7 @@
       "-.slice" = {
         sliceConfig = {
           ManagedOOMMemoryPressure = "kill";
-          ManagedOOMMemoryPressureLimit = "90%";
+          ManagedOOMMemoryPressureLimit = config.system.memory.oomd.rootPressureLimit;
         };
       };
     };
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+#
+# Stub for the external tools the cairn jobs call (lspci, nix,
+# nix-instantiate, nix-store, nixos-generate-config, nixos-install).
+# Each wrapper in this directory execs this script with its own name.
+# Output is replayed from the fixtures, at a configurable rate:
+#
+#   BENCH_MACHINE_DIR   fixture machine directory (for lspci.txt)
+#   BENCH_FIXTURES      fixtures root (hardware-configuration.nix)
+#   BENCH_PATHS         store paths in the replayed nix build (2500)
+#   BENCH_BUILDS        derivations built locally in that build (12)
+#   BENCH_REPLAY_RATE   nix build log events per second, 0 = unthrottled
+#   BENCH_LOCK_SECONDS  time nix flake lock takes (0)
+#   BENCH_EVAL_SECONDS  time each nix-instantiate --eval takes (0)
+
+import json
+import os
+import re
+import shutil
+import sys
+import time
+
+
+def env_float(name, default):
+    return float(os.environ.get(name) or default)
+
+
+def lspci(args):
+    machine = os.environ.get("BENCH_MACHINE_DIR", "")
+    with open(os.path.join(machine, "lspci.txt")) as f:
+        sys.stdout.write(f.read())
+
+
+def nixos_generate_config(args):
+    root = args[args.index("--root") + 1]
+    etc = os.path.join(root, "etc/nixos")
+    os.makedirs(etc, exist_ok=True)
+    shutil.copy(os.path.join(os.environ["BENCH_FIXTURES"],
+                             "hardware-configuration.nix"),
+                os.path.join(etc, "hardware-configuration.nix"))
+    with open(os.path.join(etc, "configuration.nix"), "w") as f:
+        f.write("{ ... }: { }\n")
+
+
+def nix_instantiate(args):
+    if "--find-file" in args:
+        print(os.environ.get("BENCH_NIXPKGS", "/nix/store/bench-nixpkgs"))
+        return
+    time.sleep(env_float("BENCH_EVAL_SECONDS", 0))
+    expr = args[args.index("-E") + 1]
+    packages = re.findall(r'^\s*"([^"]+)" = check', expr, re.MULTILINE)
+    print(json.dumps({p: ("broadcom" in p or "nvidia" in p)
+                      for p in packages}))
+
+
+class Log:
+    """Writes internal-json events to stderr at BENCH_REPLAY_RATE."""
+
+    def __init__(self):
+        rate = env_float("BENCH_REPLAY_RATE", 0)
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.next_id = 1
+
+    def emit(self, **event):
+        sys.stderr.write("@nix " + json.dumps(event) + "\n")
+        if self.interval:
+            time.sleep(self.interval)
+
+    def start(self, act_type, text="", parent=0, level=3):
+        act_id = self.next_id
+        self.next_id += 1
+        self.emit(action="start", id=act_id, level=level, type=act_type,
+                  text=text, fields=[], parent=parent)
+        return act_id
+
+    def stop(self, act_id):
+        self.emit(action="stop", id=act_id)
+
+    def result(self, act_id, res_type, fields):
+        self.emit(action="result", id=act_id, type=res_type, fields=fields)
+
+
+def nix_build(args):
+    paths = int(os.environ.get("BENCH_PATHS") or 2500)
+    builds = int(os.environ.get("BENCH_BUILDS") or 12)
+    nar_size = 1536 * 1024
+    download_size = 512 * 1024
+
+    if "--dry-run" in args:
+        # Plain nix output; each enabled option in the host adds a bit
+        flake = next(a for a in args if "#nixosConfigurations." in a)
+        hosts = os.path.join(flake.split("#")[0], "hosts")
+        enabled = 0
+        for name in os.listdir(hosts):
+            if name.endswith(".nix"):
+                with open(os.path.join(hosts, name)) as f:
+                    enabled += f.read().count("= true;")
+        paths += 100 * enabled
+        print("these {} derivations will be built:".format(builds),
+              file=sys.stderr)
+        for b in range(builds):
+            print("  /nix/store/{:032d}-bench-drv-{}.drv".format(b, b),
+                  file=sys.stderr)
+        print("these {} paths will be fetched ({:.2f} MiB download, "
+              "{:.2f} MiB unpacked):".format(
+                  paths, paths * download_size / 2**20,
+                  paths * nar_size / 2**20), file=sys.stderr)
+        for i in range(paths):
+            print("  /nix/store/{:032d}-bench-path-{}".format(i, i),
+                  file=sys.stderr)
+        return
+
+    log = Log()
+    log.emit(action="msg", level=3,
+             msg="these {} derivations will be built:".format(builds))
+    log.emit(action="msg", level=3,
+             msg="these {} paths will be fetched ({:.1f} MiB download, "
+                 "{:.1f} MiB unpacked):".format(
+                     paths, paths * download_size / 2**20,
+                     paths * nar_size / 2**20))
+
+    realise = log.start(102, level=0)
+    copy_paths = log.start(103, parent=realise, level=0)
+    all_builds = log.start(104, parent=realise, level=0)
+    log.result(copy_paths, 106, [101, paths * download_size])
+    log.result(copy_paths, 106, [100, paths * nar_size])
+
+    for i in range(paths):
+        path = "/nix/store/{:032d}-bench-path-{}".format(i, i)
+        sub = log.start(108, "copying path '{}' from "
+                        "'https://cache.nixos.org'".format(path),
+                        parent=copy_paths, level=4)
+        transfer = log.start(101, "downloading 'https://cache.nixos.org/"
+                             "nar/{:052d}.nar.xz'".format(i),
+                             parent=sub, level=5)
+        for part in (1, 2, 4):
+            log.result(transfer, 105,
+                       [download_size * part // 4 if part < 4
+                        else download_size, download_size, 0, 0])
+        log.stop(transfer)
+        log.stop(sub)
+        log.result(copy_paths, 105, [i + 1, paths, 1, 0])
+
+    log.result(all_builds, 105, [0, builds, 0, 0])
+    for b in range(builds):
+        build = log.start(105, "building '/nix/store/{:032d}-bench-drv-{}"
+                          ".drv'".format(b, b), parent=all_builds)
+        for n in range(40):
+            log.result(build, 101, ["bench-drv-{}: step {}".format(b, n)])
+        log.stop(build)
+        log.result(all_builds, 105, [b + 1, builds, 0, 0])
+
+    log.stop(all_builds)
+    log.stop(copy_paths)
+    log.stop(realise)
+    print("/nix/store/{:032d}-nixos-system-bench".format(0))
+
+
+def nix(args):
+    if "build" in args:
+        nix_build(args)
+    elif "lock" in args:
+        time.sleep(env_float("BENCH_LOCK_SECONDS", 0))
+        with open("flake.lock", "w") as f:
+            f.write('{"nodes": {"root": {}}, "root": "root", "version": 7}\n')
+    elif "path-info" in args:
+        print("{}")
+
+
+def nix_store(args):
+    # Validity in a --store root is a list of paths in a file there; the
+    # live store has everything
+    root = args[args.index("--store") + 1] if "--store" in args else None
+    db = os.path.join(root or "/", "nix/var/nix/db/bench-valid")
+    paths = [a for a in args if a.startswith("/nix/store/")]
+    if "--check-validity" in args and root:
+        os.makedirs(os.path.join(root, "nix/store"), exist_ok=True)
+        valid = set()
+        if os.path.exists(db):
+            with open(db) as f:
+                valid = set(f.read().split())
+        print("\n".join(p for p in paths if p not in valid))
+    elif "--dump-db" in args:
+        print("\n".join(paths))
+    elif "--load-db" in args:
+        os.makedirs(os.path.dirname(db), exist_ok=True)
+        with open(db, "a") as f:
+            f.write(sys.stdin.read())
+
+
+TOOLS = {
+    "lspci": lspci,
+    "nix": nix,
+    "nix-instantiate": nix_instantiate,
+    "nix-store": nix_store,
+    "nixos-generate-config": nixos_generate_config,
+    "nixos-install": lambda args: None,
+}
+
+
+if __name__ == "__main__":
+    TOOLS[sys.argv[1]](sys.argv[2:])
@@ -0,0 +1,81 @@
+# SPDX-License-Identifier: MIT
+#
+# Stand-in for the libcalamares module Calamares injects into Python job
+# modules. Implements only what the cairn and cairndetect jobs use, and
+# records progress and log output so the benchmarks can inspect them.
+
+import os
+
+
+class GlobalStorage:
+    """Dict-backed libcalamares.globalstorage."""
+
+    def __init__(self):
+        self._data = {}
+
+    def insert(self, key, value):
+        self._data[key] = value
+
+    def value(self, key):
+        return self._data.get(key)
+
+    def contains(self, key):
+        return key in self._data
+
+    def remove(self, key):
+        return self._data.pop(key, None) is not None
+
+    def keys(self):
+        return list(self._data)
+
+    def count(self):
+        return len(self._data)
+
+    def clear(self):
+        self._data.clear()
+
+
+class Job:
+    """libcalamares.job: module configuration, working path, progress."""
+
+    def __init__(self):
+        self.configuration = {}
+        self.working_path = ""
+        self.pretty_name = ""
+        self.progress = []
+
+    def setprogress(self, value):
+        self.progress.append(value)
+
+
+class Utils:
+    """libcalamares.utils logging; set echo to print messages as well."""
+
+    def __init__(self):
+        self.messages = []
+        self.echo = bool(os.environ.get("BENCH_ECHO"))
+
+    def debug(self, message):
+        self.messages.append(message)
+        if self.echo:
+            print("DEBUG:", message)
+
+    def warning(self, message):
+        self.debug(message)
+
+    def error(self, message):
+        self.debug(message)
+
+
+globalstorage = GlobalStorage()
+job = Job()
+utils = Utils()
+
+
+def reset(configuration=None, working_path=""):
+    """Start a fresh job: empty globalstorage, log and progress."""
+    globalstorage.clear()
+    job.configuration = dict(configuration or {})
+    job.working_path = working_path
+    job.progress = []
+    utils.messages = []
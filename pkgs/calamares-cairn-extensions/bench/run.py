@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+#
+# Benchmarks for the cairn and cairndetect Calamares job modules.
+#
+# Runs the jobs outside Calamares against the stand-in libcalamares in
+# this directory, the recorded sysfs/procfs trees under fixtures/, and
+# the replaying tool stubs under bin/. See README.md.
+
+import argparse
+import functools
+import http.server
+import importlib.util
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+MODULES_DIR = os.path.join(BENCH_DIR, os.pardir, "src", "modules")
+FIXTURES_DIR = os.path.join(BENCH_DIR, "fixtures")
+MACHINES = ("laptop-hybrid", "workstation-amd")
+
+sys.path.insert(0, BENCH_DIR)
+import libcalamares  # noqa: E402  (the stand-in, not the real one)
+
+
+def load_job(name):
+    """Import src/modules/<name>/main.py as a fresh module."""
+    path = os.path.join(MODULES_DIR, name, "main.py")
+    spec = importlib.util.spec_from_file_location(
+        "{}_job".format(name), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def stub_environment(machine_dir=""):
+    """Put the tool stubs first on PATH and point them at the fixtures."""
+    os.environ["PATH"] = os.path.join(BENCH_DIR, "bin") + os.pathsep + \
+        os.environ.get("PATH", "")
+    os.environ["BENCH_FIXTURES"] = FIXTURES_DIR
+    os.environ["BENCH_MACHINE_DIR"] = machine_dir
+
+
+def machine_root(name, tmp):
+    """
+    Copy a fixture machine into tmp and expand its recorded cpuinfo block
+    to one block per thread, as the kernel would. Returns the root.
+    """
+    src = os.path.join(FIXTURES_DIR, name)
+    root = os.path.join(tmp, name)
+    if os.path.exists(root):
+        return root
+    shutil.copytree(src, root, symlinks=True)
+    with open(os.path.join(src, "machine.json")) as f:
+        threads = json.load(f)["threads"]
+
+    cpuinfo = os.path.join(root, "proc/cpuinfo")
+    with open(cpuinfo) as f:
+        block = f.read().strip("\n")
+    with open(cpuinfo, "w") as f:
+        for cpu in range(threads):
+            lines = []
+            for line in block.splitlines():
+                key = line.split(":", 1)[0].strip()
+                if key in ("processor", "apicid", "initial apicid"):
+                    line = "{}: {}".format(line.split(":", 1)[0], cpu)
+                lines.append(line)
+            f.write("\n".join(lines) + "\n\n")
+    return root
+
+
+# Fake binary caches for substituter probing: name -> seconds of delay
+# before each response. "down" is a URL nothing listens on.
+FAKE_CACHES = {"lan": 0.0, "wan": 0.04}
+PROBE_HASH = "0" * 32
+PROBE_NAR = b"\0" * (256 * 1024)
+
+
+class FakeCacheHandler(http.server.BaseHTTPRequestHandler):
+    """Serves nix-cache-info, one narinfo and its NAR for each FAKE_CACHES entry."""
+
+    def do_GET(self):
+        name, _, path = self.path.lstrip("/").partition("/")
+        if name not in FAKE_CACHES:
+            self.send_error(404)
+            return
+        time.sleep(FAKE_CACHES[name])
+        if path == "nix-cache-info":
+            body = b"StoreDir: /nix/store\nWantMassQuery: 1\nPriority: 40\n"
+        elif path == PROBE_HASH + ".narinfo":
+            body = "StorePath: /nix/store/{}-probe\nURL: nar/probe.nar\n" \
+                   "Compression: none\n".format(PROBE_HASH).encode()
+        elif path == "nar/probe.nar":
+            body = PROBE_NAR
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_fake_caches():
+    """Serve FAKE_CACHES on localhost; returns {name: url}, "down" included."""
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FakeCacheHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = "http://127.0.0.1:{}".format(server.server_address[1])
+    urls = {name: "{}/{}".format(base, name) for name in FAKE_CACHES}
+    # Bind and close a socket to get a port nothing listens on
+    closed = http.server.HTTPServer(("127.0.0.1", 0), FakeCacheHandler)
+    urls["down"] = "http://127.0.0.1:{}".format(closed.server_address[1])
+    closed.server_close()
+    return urls
+
+
+# ─── Benchmarks ───────────────────────────────────────────────────
+# Each benchmark takes the shared context and returns a callable that
+# performs one timed iteration.
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def _per_machine(prefix, make):
+    for machine in MACHINES:
+        BENCHMARKS["{}/{}".format(prefix, machine)] = functools.partial(
+            make, machine=machine)
+
+
+def bench_cpuinfo(ctx, machine):
+    detect = ctx["detect"]
+    path = os.path.join(machine_root(machine, ctx["tmp"]), "proc/cpuinfo")
+    return lambda: detect.parse_cpuinfo(path)
+
+
+def machine_probes(detect, root):
+    """detect.PROBES with each probe pointed at a fixture root."""
+    proc = os.path.join(root, "proc")
+    sysfs = os.path.join(root, "sys")
+    roots = {
+        "cpu": (proc, sysfs),
+        "memory": (proc,),
+    }
+    return [(name, functools.partial(func, *roots.get(name, (sysfs,))),
+             deadline, fallback)
+            for name, func, deadline, fallback in detect.PROBES]
+
+
+def bench_detect(ctx, machine):
+    detect = ctx["detect"]
+    probes = machine_probes(detect, machine_root(machine, ctx["tmp"]))
+
+    def run():
+        results, _ = detect.run_probes(probes)
+        return detect.build_profile(results)
+    return run
+
+
+def bench_detect_lspci(ctx, machine):
+    detect = ctx["detect"]
+    machine_dir = os.path.join(FIXTURES_DIR, machine)
+
+    def run():
+        os.environ["BENCH_MACHINE_DIR"] = machine_dir
+        return detect._detect_gpu_lspci()
+    return run
+
+
+def bench_target_storage(ctx, machine):
+    cairn = ctx["cairn"]
+    root = machine_root(machine, ctx["tmp"])
+    mountinfo = os.path.join(root, "proc/mountinfo")
+    sysfs = os.path.join(root, "sys")
+    return lambda: cairn.target_storage("/mnt", mountinfo, sysfs)
+
+
+_per_machine("cpuinfo", bench_cpuinfo)
+_per_machine("detect", bench_detect)
+_per_machine("detect-lspci", bench_detect_lspci)
+_per_machine("target-storage", bench_target_storage)
+
+
+@benchmark("render")
+def bench_render(ctx):
+    cairn = ctx["cairn"]
+    answers = ctx["answers"]
+
+    def run():
+        variables = cairn.build_variables(answers.get)
+        for template in (cairn.cfg_flake, cairn.cfg_host, cairn.cfg_user):
+            cairn.render(template, variables)
+    return run
+
+
+@benchmark("hwconfig-rewrite")
+def bench_hwconfig(ctx):
+    cairn = ctx["cairn"]
+    path = os.path.join(ctx["tmp"], "hardware.nix")
+    cache = os.path.join(ctx["tmp"], "unfree-cache.json")
+    fixture = os.path.join(FIXTURES_DIR, "hardware-configuration.nix")
+
+    def run():
+        shutil.copy(fixture, path)
+        if os.path.exists(cache):
+            os.remove(cache)
+        cairn.rewrite_hardware_config(
+            path, {"allowUnfree": False, "unfreeCache": cache})
+    return run
+
+
+@benchmark("log-parse")
+def bench_log_parse(ctx):
+    cairn = ctx["cairn"]
+    lines = ctx["nix_log"]
+
+    def run():
+        progress = cairn.NixProgress()
+        for line in lines:
+            progress.feed(line)
+        return progress.fraction()
+    return run
+
+
+@benchmark("substituters")
+def bench_substituters(ctx):
+    cairn = ctx["cairn"]
+    caches = ctx["caches"]
+    urls = [caches["down"], caches["wan"], caches["lan"]]
+
+    def run():
+        probes = cairn.probe_substituters(urls, PROBE_HASH)
+        ranked = cairn.rank_substituters(urls, probes)
+        if ranked != [caches["lan"], caches["wan"]]:
+            raise RuntimeError("unexpected ranking: {}".format(ranked))
+    return run
+
+
+@benchmark("plan")
+def bench_plan(ctx):
+    cairn = ctx["cairn"]
+    answers = ctx["answers"]
+    config = {
+        "installMode": "online",
+        "sourcePin": os.path.join(ctx["tmp"], "no-pin.json"),
+        "substituters": sorted(ctx["caches"].values()),
+    }
+    state_dir = os.path.join(ctx["tmp"], "plan")
+
+    def run():
+        libcalamares.reset(config, os.path.join(MODULES_DIR, "cairn"))
+        for key, value in answers.items():
+            libcalamares.globalstorage.insert(key, value)
+        plan = cairn.plan_install(libcalamares.globalstorage, config,
+                                  state_dir)
+        if plan["minimal"]["downloadBytes"] >= plan["selected"]["downloadBytes"]:
+            raise RuntimeError("no savings without optional features")
+    return run
+
+
+def live_store(tmp, paths=300):
+    """
+    A synthetic live store under tmp: paths store paths, each a small
+    tree whose files repeat across paths the way licences, locales and
+    shared libraries do. Returns (source root, store paths).
+    """
+    source = os.path.join(tmp, "live")
+    store = os.path.join(source, "nix/store")
+    if os.path.isdir(store):
+        return source, sorted("/nix/store/" + n for n in os.listdir(store))
+    os.makedirs(store)
+    for i in range(paths):
+        path = os.path.join(store, "{:032d}-seed-path-{}".format(i, i))
+        os.makedirs(os.path.join(path, "share/doc"))
+        os.makedirs(os.path.join(path, "bin"))
+        with open(os.path.join(path, "share/doc/LICENSE"), "wb") as f:
+            f.write(b"Permission is hereby granted... " * (i % 5 + 1) * 64)
+        with open(os.path.join(path, "bin/tool"), "wb") as f:
+            f.write(os.urandom(64 * 1024))
+        os.chmod(os.path.join(path, "bin/tool"), 0o555)
+        with open(os.path.join(path, "lib.so"), "wb") as f:
+            f.write(bytes([i % 7]) * 256 * 1024)
+        os.symlink("bin/tool", os.path.join(path, "default"))
+    return source, sorted("/nix/store/" + n for n in os.listdir(store))
+
+
+@benchmark("store-seed")
+def bench_store_seed(ctx):
+    cairn = ctx["cairn"]
+    source, paths = live_store(ctx["tmp"])
+
+    def run():
+        target = tempfile.mkdtemp(dir=ctx["tmp"])
+        stats = cairn.seed_target_store(paths, target, 8, source)
+        shutil.rmtree(target)
+        if len(stats["seeded"]) != len(paths) or not stats.get("linkedBytes"):
+            raise RuntimeError("unexpected seeding: {}".format(
+                {k: v for k, v in stats.items() if k != "seeded"}))
+    return run
+
+
+@benchmark("install")
+def bench_install(ctx):
+    cairn = ctx["cairn"]
+    answers = ctx["answers"]
+    config = {
+        "installMode": "online",
+        "unfreeCache": os.path.join(ctx["tmp"], "install-unfree.json"),
+        "sourcePin": os.path.join(ctx["tmp"], "no-pin.json"),
+        "substituters": sorted(ctx["caches"].values()),
+    }
+
+    def run():
+        libcalamares.reset(config, os.path.join(MODULES_DIR, "cairn"))
+        target = tempfile.mkdtemp(dir=ctx["tmp"])
+        for key, value in answers.items():
+            libcalamares.globalstorage.insert(key, value)
+        libcalamares.globalstorage.insert("rootMountPoint", target)
+        result = cairn.run()
+        shutil.rmtree(target)
+        if result is not None:
+            raise RuntimeError("install failed: {}".format(result))
+    return run
+
+
+# ─── Runner ───────────────────────────────────────────────────────
+
+def capture_nix_log():
+    """Record the stub's nix build log once for the parser benchmark."""
+    result = subprocess.run(
+        [os.path.join(BENCH_DIR, "bin", "nix"), "build"],
+        capture_output=True, text=True, check=True)
+    return result.stderr.splitlines()
+
+
+def time_benchmark(func, repeat):
+    func()  # warm up caches and imports
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return {
+        "min": min(samples),
+        "median": statistics.median(samples),
+        "repeat": repeat,
+    }
+
+
+def compare(results, baseline, threshold):
+    """Return names of benchmarks whose median regressed past threshold."""
+    regressions = []
+    for name, result in results.items():
+        old = baseline.get(name)
+        if not old:
+            continue
+        change = result["median"] / old["median"] - 1
+        result["change"] = change
+        if change > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the cairn Calamares jobs.")
+    parser.add_argument("-k", "--filter", default="",
+                        help="only run benchmarks whose name contains this")
+    parser.add_argument("-n", "--repeat", type=int, default=5)
+    parser.add_argument("--save", metavar="FILE",
+                        help="write results as a JSON baseline")
+    parser.add_argument("--compare", metavar="FILE",
+                        help="compare against a saved baseline")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="allowed median slowdown vs baseline (0.25)")
+    args = parser.parse_args()
+
+    stub_environment()
+    with tempfile.TemporaryDirectory(prefix="cairn-bench-") as tmp:
+        libcalamares.reset()
+        with open(os.path.join(FIXTURES_DIR, "answers.json")) as f:
+            answers = json.load(f)
+        ctx = {
+            "tmp": tmp,
+            "answers": answers,
+            "detect": load_job("cairndetect"),
+            "cairn": load_job("cairn"),
+            "nix_log": capture_nix_log(),
+            "caches": start_fake_caches(),
+        }
+
+        results = {}
+        for name, make in BENCHMARKS.items():
+            if args.filter not in name:
+                continue
+            results[name] = time_benchmark(make(ctx), args.repeat)
+
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+
+    width = max([len(n) for n in results] or [0])
+    for name, result in results.items():
+        change = result.get("change")
+        print("{:<{}}  median {:>10.3f} ms  min {:>10.3f} ms{}".format(
+            name, width, result["median"] * 1000, result["min"] * 1000,
+            "  {:+.0%}".format(change) if change is not None else ""))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if regressions:
+        print("\nRegressed by more than {:.0%}: {}".format(
+            args.threshold, ", ".join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,97 @@
+import io.calamares.core
+import QtQuick
+import QtQuick.Controls
+import QtQuick.Layouts
+import org.kde.kirigami as Kirigami
+
+Page {
+    id: page
+    width: parent.width
+    height: parent.height
+
+    // Recorded by the cairn@plan job that runs just before this page
+    property var plan: ({})
+    // Feature toggles as chosen, restored if the box is unticked again
+    property var chosenFeatures: ({})
+
+    // Called by Calamares each time the page is shown
+    function onActivate() {
+        plan = Global.value("cairn_installPlan") || {}
+    }
+
+    function setMinimal(minimal) {
+        var features = plan.optionalFeatures || []
+        if (minimal) {
+            var chosen = {}
+            for (var i = 0; i < features.length; i++) {
+                chosen[features[i]] = Global.value(features[i])
+                Global.insert(features[i], false)
+            }
+            chosenFeatures = chosen
+        } else {
+            for (var key in chosenFeatures)
+                Global.insert(key, chosenFeatures[key])
+        }
+        Global.insert("cairn_planMinimal", minimal)
+    }
+
+    ColumnLayout {
+        anchors.fill: parent
+        anchors.margins: Kirigami.Units.largeSpacing
+        spacing: Kirigami.Units.largeSpacing
+
+        Label {
+            text: qsTr("Before you partition")
+            font.pointSize: 14
+            font.bold: true
+        }
+
+        Label {
+            Layout.fillWidth: true
+            wrapMode: Text.WordWrap
+            visible: !!page.plan.selected
+            text: qsTr("Installing the configuration you chose needs:")
+        }
+
+        Label {
+            Layout.fillWidth: true
+            wrapMode: Text.WordWrap
+            visible: !!page.plan.selected
+            text: page.plan.selected ? page.plan.selected.text : ""
+            font.pointSize: 11
+        }
+
+        Label {
+            Layout.fillWidth: true
+            wrapMode: Text.WordWrap
+            visible: !!page.plan.selected && page.plan.selected.build > 20
+            text: qsTr("Some packages are not in the binary caches and will be built from source, which can take much longer on a slow machine.")
+        }
+
+        Label {
+            Layout.fillWidth: true
+            wrapMode: Text.WordWrap
+            visible: !!page.plan.error
+            text: qsTr("The install size could not be estimated. You can still continue.")
+        }
+
+        CheckBox {
+            Layout.topMargin: Kirigami.Units.largeSpacing
+            visible: !!page.plan.minimal
+            text: qsTr("Install without the optional features (%1)").arg(
+                page.plan.savingsText || "")
+            onCheckedChanged: page.setMinimal(checked)
+        }
+
+        Label {
+            Layout.fillWidth: true
+            wrapMode: Text.WordWrap
+            visible: !!page.plan.minimal
+            text: qsTr("You can turn them on later in your configuration. The installer cannot go back to the feature page from here.")
+        }
+
+        Item {
+            Layout.fillHeight: true
+        }
+    }
+}
@@ -6,18 +6,54 @@
 # Generates an Cairn flake structure and runs nixos-install.
 # Replaces the upstream NixOS "nixos" job module.
 
+import collections
+import contextlib
+import fcntl
+import gzip
+import hashlib
+import itertools
+import json
 import os
 import re
+import resource
+import shlex
 import shutil
+import signal
+import stat
 import subprocess
-import libcalamares
+import sys
+import tempfile
+import threading
+import time
+import types
+import urllib.request
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+
+try:
+    import libcalamares
+except ImportError:
+    # Running headless (python3 main.py ...); main() provides a stand-in
+    libcalamares = None
+
+DEFAULT_UNFREE_CACHE = "/var/cache/cairn-installer/unfree-status.json"
+DEFAULT_SOURCE_PIN = "/etc/cairn-installer/source.json"
+
+NIX_FLAGS = ["--extra-experimental-features", "nix-command flakes"]
+
+# Seconds between progress bar updates and install log summaries
+PROGRESS_INTERVAL = 0.5
+SUMMARY_INTERVAL = 10
+
+# Probed to decide whether "auto" install mode can reach the network
+NETWORK_CHECK_URL = "https://cache.nixos.org/nix-cache-info"
 
 # ─── Template constants ───────────────────────────────────────────
 # Using @@var@@ markers to avoid conflict with Nix's { } braces.
 
 cfg_flake = """\
 {
-  description = "NixOS configuration for @@hostname@@";
+  description = "@@description@@";
 
   inputs = {
     # Use cairn as the base framework
@@ -39,7 +75,7 @@ cfg_flake = """\
     in
     {
       nixosConfigurations = {
-        @@hostname@@ = mkHost "@@hostname@@";
+@@host_entries@@
       };
     };
 }
@@ -120,6 +156,200 @@ cfg_user = """\
 """
 
 
+# ─── Install metrics ──────────────────────────────────────────────
+# Every phase and every subprocess of the job is timed; the report is
+# written to /etc/nixos/.install-metrics.json on the target.
+
+METRICS_FILE = "etc/nixos/.install-metrics.json"
+
+
+class RusagePopen(subprocess.Popen):
+    """Popen that keeps the child's resource usage when it is reaped."""
+
+    rusage = None
+
+    def _try_wait(self, wait_flags):
+        # Same contract as Popen._try_wait, but via wait4 for the rusage
+        try:
+            pid, status, rusage = os.wait4(self.pid, wait_flags)
+        except ChildProcessError:
+            return (self.pid, 0)
+        if pid == self.pid:
+            self.rusage = rusage
+        return (pid, status)
+
+
+def _cpu_seconds():
+    """CPU time used so far by this process and its reaped children."""
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (own.ru_utime + own.ru_stime
+            + children.ru_utime + children.ru_stime)
+
+
+class InstallMetrics:
+    """
+    Wall time, CPU time and peak child RSS per phase and per command.
+    Phases run by run_tasks() overlap; CPU time is the whole job's over
+    each phase's span, so overlapping phases share it.
+    """
+
+    def __init__(self):
+        # Phase of the commands each thread runs
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.started = datetime.now(timezone.utc)
+        self.start = time.monotonic()
+        self.phases = []
+        self.commands = []
+        self.extra = {}
+        self._current = None
+
+    def _begin(self, name):
+        self._local.phase = name
+        return {"name": name, "start": time.monotonic(), "cpu": _cpu_seconds()}
+
+    def _finish(self, current):
+        self._local.phase = None
+        with self._lock:
+            commands = [c for c in self.commands
+                        if c["phase"] == current["name"]]
+            self.phases.append({
+                "name": current["name"],
+                "startSeconds": round(current["start"] - self.start, 3),
+                "wallSeconds": round(time.monotonic() - current["start"], 3),
+                "cpuSeconds": round(_cpu_seconds() - current["cpu"], 3),
+                "peakChildRssKiB": max(
+                    [c["peakRssKiB"] for c in commands] or [0]),
+                "commands": len(commands),
+            })
+
+    def phase(self, name):
+        """End the current phase, if any, and start timing a new one."""
+        self.end_phase()
+        self._current = self._begin(name)
+
+    def end_phase(self):
+        current, self._current = self._current, None
+        if current is not None:
+            self._finish(current)
+
+    @contextlib.contextmanager
+    def task(self, name):
+        """Time a phase that runs on its own thread, alongside others."""
+        current = self._begin(name)
+        try:
+            yield
+        finally:
+            self._finish(current)
+
+    def record_command(self, name, cmd, start, proc):
+        rusage = proc.rusage
+        record = {
+            "name": name,
+            "phase": getattr(self._local, "phase", None),
+            "argv": [str(a) for a in cmd[:3]],
+            "wallSeconds": round(time.monotonic() - start, 3),
+            "userSeconds": round(rusage.ru_utime, 3) if rusage else None,
+            "systemSeconds": round(rusage.ru_stime, 3) if rusage else None,
+            # ru_maxrss is in KiB on Linux
+            "peakRssKiB": rusage.ru_maxrss if rusage else 0,
+            "returncode": proc.returncode,
+        }
+        with self._lock:
+            self.commands.append(record)
+
+    def report(self, result):
+        self.end_phase()
+        report = {
+            "version": 1,
+            "started": self.started.isoformat(),
+            "totalSeconds": round(time.monotonic() - self.start, 3),
+            "result": "ok" if result is None else result[0],
+            "phases": sorted(self.phases, key=lambda ph: ph["startSeconds"]),
+            "commands": self.commands,
+        }
+        report.update(self.extra)
+        return report
+
+    def summary(self):
+        """Human-readable lines for the Calamares log."""
+        lines = ["Install timing ({:.1f}s total):".format(
+            time.monotonic() - self.start)]
+        for ph in sorted(self.phases, key=lambda ph: ph["startSeconds"]):
+            lines.append("  {:<16} {:>8.1f}s wall {:>8.1f}s cpu{}".format(
+                ph["name"], ph["wallSeconds"], ph["cpuSeconds"],
+                ", peak child RSS {:.0f} MiB".format(
+                    ph["peakChildRssKiB"] / 1024)
+                if ph["peakChildRssKiB"] else ""))
+        return lines
+
+
+METRICS = InstallMetrics()
+
+# Commands run_command is waiting on, so that a failed phase can stop the
+# ones running alongside it
+_running_commands = set()
+
+
+def terminate_commands():
+    """Terminate every command run_command is still waiting on."""
+    for proc in list(_running_commands):
+        try:
+            proc.terminate()
+        except OSError:
+            pass
+
+
+def run_command(name, cmd, check=False, timeout=None, capture_output=False,
+                input=None, **kwargs):
+    """
+    subprocess.run() that records the command in METRICS under name.
+    Raises the same exceptions as subprocess.run().
+    """
+    if capture_output:
+        kwargs["stdout"] = subprocess.PIPE
+        kwargs["stderr"] = subprocess.PIPE
+    if input is not None:
+        kwargs["stdin"] = subprocess.PIPE
+    start = time.monotonic()
+    with RusagePopen(cmd, **kwargs) as proc:
+        _running_commands.add(proc)
+        try:
+            stdout, stderr = proc.communicate(input, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.communicate()
+            METRICS.record_command(name, cmd, start, proc)
+            raise
+        except BaseException:
+            proc.kill()
+            raise
+        finally:
+            _running_commands.discard(proc)
+    METRICS.record_command(name, cmd, start, proc)
+    if check and proc.returncode:
+        raise subprocess.CalledProcessError(
+            proc.returncode, cmd, output=stdout, stderr=stderr)
+    return subprocess.CompletedProcess(cmd, proc.returncode, stdout, stderr)
+
+
+def write_metrics(root_mount_point, report):
+    """Write the metrics report to the target, if /etc/nixos exists."""
+    path = os.path.join(root_mount_point, METRICS_FILE)
+    if not os.path.isdir(os.path.dirname(path)):
+        return
+    try:
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+    except OSError as e:
+        libcalamares.utils.debug(
+            "Could not write install metrics: {}".format(e))
+
+
 def catenate(d, key, *args):
     """Set d[key] to the concatenation of args, but only if no arg is None."""
     for a in args:
@@ -140,6 +370,36 @@ def nix_string_or_null(val):
     return "null"
 
 
+def nix_string(val):
+    """Render val as a double-quoted Nix string literal, escaped."""
+    escaped = (val.replace("\\", "\\\\").replace('"', '\\"')
+               .replace("${", "\\${").replace("\n", "\\n"))
+    return '"{}"'.format(escaped)
+
+
+def nix_list(items):
+    """Render a list of strings as a Nix list literal."""
+    return "[ {} ]".format(" ".join('"{}"'.format(i) for i in items))
+
+
+# nix's default system-features; setting the option replaces this list
+NIX_BASE_SYSTEM_FEATURES = ["nixos-test", "benchmark", "big-parallel", "kvm"]
+
+X86_64_LEVELS = ("v2", "v3", "v4")
+
+
+def cpu_system_features(level):
+    """
+    Build nix.settings.system-features for an x86-64 psABI level, adding
+    gccarch-x86-64-vN for every level up to and including the detected one.
+    """
+    features = list(NIX_BASE_SYSTEM_FEATURES)
+    if level in X86_64_LEVELS:
+        for lvl in X86_64_LEVELS[:X86_64_LEVELS.index(level) + 1]:
+            features.append("gccarch-x86-64-{}".format(lvl))
+    return features
+
+
 def generate_proxy_strings():
     """Build env command prefix for proxy variables."""
     assignments = []
@@ -153,141 +413,1857 @@ def generate_proxy_strings():
     return []
 
 
-def fix_btrfs_subvolumes(hw_config_path):
+# ─── hardware.nix rewriting ───────────────────────────────────────
+# nixos-generate-config output is parsed once into its fileSystems and
+# boot.* list attributes. Registered transforms edit that model in
+# order and the file is written back once, atomically.
+
+FILESYSTEM_RE = re.compile(
+    r'fileSystems\."(?P<mount>[^"]+)"\s*=\s*\{(?P<body>[^}]*)\}', re.DOTALL)
+FS_OPTIONS_RE = re.compile(r'options\s*=\s*\[(?P<items>[^\]]*)\]')
+BOOT_LIST_RE = re.compile(
+    r'(?P<attr>boot\.[\w.]+)\s*=\s*\[(?P<items>[^\]]*)\]')
+
+
+class FileSystem:
+    """One fileSystems."<mount>" entry; options is a list of strings."""
+
+    def __init__(self, mount, body, body_start):
+        self.mount = mount
+        self.fs_type = None
+        fs_type = re.search(r'fsType\s*=\s*"([^"]*)"', body)
+        if fs_type:
+            self.fs_type = fs_type.group(1)
+        self.body_end = body_start + len(body.rstrip())
+        self.options_span = None
+        self.original_options = None
+        match = FS_OPTIONS_RE.search(body)
+        if match:
+            self.options_span = (body_start + match.start("items"),
+                                 body_start + match.end("items"))
+            self.original_options = re.findall(r'"([^"]*)"',
+                                               match.group("items"))
+        self.options = list(self.original_options or [])
+
+
+def _list_items(items):
+    """Nix list contents as nixos-generate-config spaces them."""
+    items = " ".join(items)
+    return " {} ".format(items) if items else " "
+
+
+class HardwareConfig:
+    """
+    hardware-configuration.nix text with its fileSystems entries and
+    boot.* list attributes (boot.extraModulePackages, ...) parsed out.
+    Everything else is carried through untouched by render().
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.filesystems = {}
+        for match in FILESYSTEM_RE.finditer(text):
+            fs = FileSystem(match.group("mount"), match.group("body"),
+                            match.start("body"))
+            self.filesystems[fs.mount] = fs
+
+        self.boot_lists = {}
+        self._boot_spans = {}
+        for match in BOOT_LIST_RE.finditer(text):
+            attr = match.group("attr")
+            self.boot_lists[attr] = match.group("items").split()
+            self._boot_spans[attr] = (match.start("items"),
+                                      match.end("items"))
+        self._boot_original = {k: list(v) for k, v in self.boot_lists.items()}
+
+    def render(self):
+        """The text with every changed list written back."""
+        edits = []
+        for fs in self.filesystems.values():
+            if fs.options == (fs.original_options or []):
+                continue
+            items = _list_items('"{}"'.format(o) for o in fs.options)
+            if fs.options_span:
+                edits.append(fs.options_span + (items,))
+            else:
+                edits.append((fs.body_end, fs.body_end,
+                              "\n      options = [{}];".format(items)))
+        for attr, items in self.boot_lists.items():
+            if items != self._boot_original[attr]:
+                edits.append(self._boot_spans[attr] + (_list_items(items),))
+
+        text = self.text
+        for start, end, replacement in sorted(edits, reverse=True):
+            text = text[:start] + replacement + text[end:]
+        return text
+
+
+HARDWARE_TRANSFORMS = []
+
+
+def hardware_transform(func):
+    """
+    Register func(hw, context) to run on every generated hardware.nix.
+    context is a dict of install settings (allowUnfree, unfreeCache).
+    """
+    HARDWARE_TRANSFORMS.append(func)
+    return func
+
+
+def write_atomic(path, text):
+    """Replace path with text via a synced temp file and rename."""
+    directory = os.path.dirname(path) or "."
+    tmp_path = os.path.join(
+        directory, ".{}.tmp".format(os.path.basename(path)))
+    with open(tmp_path, "w") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def rewrite_hardware_config(hw_config_path, context, dry_run=False):
     """
-    Fix btrfs subvolume options in hardware-configuration.nix.
-    nixos-generate-config sometimes gets subvol= paths wrong.
+    Apply HARDWARE_TRANSFORMS to hw_config_path in one read and one
+    write. With dry_run, nothing is written and a unified diff of the
+    changes is returned instead ("" if there are none).
     """
     if not os.path.exists(hw_config_path):
-        return
+        return ""
 
     with open(hw_config_path, "r") as f:
-        content = f.read()
+        original = f.read()
+
+    hw = HardwareConfig(original)
+    for transform in HARDWARE_TRANSFORMS:
+        transform(hw, context)
+    content = hw.render()
+
+    if dry_run:
+        import difflib
+        return "".join(difflib.unified_diff(
+            original.splitlines(True), content.splitlines(True),
+            hw_config_path, hw_config_path + " (rewritten)"))
+    if content != original:
+        write_atomic(hw_config_path, content)
+    return ""
+
+
+# btrfs subvolumes the mount module creates, by mount point (keep in
+# sync with btrfsSubvolumes in mount.conf). The root is the top-level
+# subvolume. nodatacow subvolumes hold files rewritten in place, such
+# as swap files, where copy-on-write only fragments them.
+BTRFS_LAYOUT = {
+    "/": {"subvol": None},
+    "/home": {"subvol": "home"},
+    "/nix": {"subvol": "nix"},
+    "/var/log": {"subvol": "var/log"},
+    "/swap": {"subvol": "swap", "nodatacow": True},
+}
 
-    # Map mount points to expected subvolume names
-    subvol_map = {
-        "/home": "home",
-        "/nix": "nix",
-    }
+# VM disk images get the same treatment when libvirt is enabled
+LIBVIRT_IMAGES = "/var/lib/libvirt/images"
 
-    for mount, subvol in subvol_map.items():
-        # Fix subvol= option for known mount points
-        pattern = r'(fileSystems\."{}"\s*=\s*\{{[^}}]*options\s*=\s*\[)([^\]]*)(])'.format(
-            re.escape(mount)
+# zstd level by the class of disk /nix is on. btrfs applies compress= to
+# the whole filesystem (the first mount's options win), so the largest,
+# most read-heavy tree picks it for every subvolume: on NVMe higher
+# levels make the CPU the bottleneck, on spinning disks they pay off.
+BTRFS_ZSTD_LEVELS = {"nvme": 1, "ssd": 3, "hdd": 6}
+BTRFS_ZSTD_DEFAULT = 3
+
+
+def _add_noatime(fs):
+    """Append noatime unless fs already has an atime option."""
+    if not any(o.endswith("atime") and o != "lazytime" for o in fs.options):
+        fs.options.append("noatime")
+
+
+@hardware_transform
+def fix_btrfs_subvolumes(hw, context):
+    """
+    Mount the btrfs subvolumes in BTRFS_LAYOUT with the right subvol=
+    (nixos-generate-config sometimes gets the paths wrong, and the root
+    has none), zstd compression and noatime.
+    """
+    level = BTRFS_ZSTD_LEVELS.get(
+        ((context.get("storage") or {}).get("/nix") or {}).get("class"),
+        BTRFS_ZSTD_DEFAULT)
+
+    for mount, layout in BTRFS_LAYOUT.items():
+        fs = hw.filesystems.get(mount)
+        if fs is None or fs.fs_type != "btrfs":
+            continue
+        options = [o for o in fs.options
+                   if not o.startswith(("subvol=", "compress"))]
+        if layout["subvol"]:
+            options.insert(0, "subvol={}".format(layout["subvol"]))
+        options.append("compress=zstd:{}".format(level))
+        fs.options = options
+        _add_noatime(fs)
+
+
+def apply_nodatacow(root, enable_libvirt=False):
+    """
+    chattr +C the nodatacow subvolumes of BTRFS_LAYOUT, and libvirt's
+    image directory when libvirt is enabled, on a btrfs target. They are
+    still empty at install time, and files created in them later inherit
+    the attribute. Returns the paths changed.
+    """
+    if (parse_mountinfo().get(root) or {}).get("fsType") != "btrfs":
+        return []
+    paths = [m for m, layout in BTRFS_LAYOUT.items() if layout.get("nodatacow")]
+    if enable_libvirt:
+        paths.append(LIBVIRT_IMAGES)
+
+    changed = []
+    for mount in paths:
+        path = os.path.join(root, mount.lstrip("/"))
+        try:
+            os.makedirs(path, exist_ok=True)
+            run_command("chattr", ["chattr", "+C", path],
+                        check=True, capture_output=True, text=True)
+        except (OSError, subprocess.CalledProcessError) as e:
+            libcalamares.utils.debug(
+                "Cannot disable copy-on-write for {}: {}".format(mount, e))
+            continue
+        changed.append(mount)
+    return changed
+
+
+def nixpkgs_revision():
+    """
+    Identify the <nixpkgs> the live system evaluates against.
+    Uses its .git-revision when present, else the resolved store path
+    (which is content-addressed, so it changes whenever nixpkgs does).
+    Returns None if <nixpkgs> can't be found.
+    """
+    try:
+        result = run_command(
+            "nix-instantiate (find nixpkgs)",
+            ["nix-instantiate", "--find-file", "nixpkgs"],
+            capture_output=True, text=True, timeout=10
         )
-        match = re.search(pattern, content, re.DOTALL)
-        if match:
-            options = match.group(2)
-            # Replace any existing subvol= with the correct one
-            new_options = re.sub(
-                r'"subvol=([^"]*)"',
-                '"subvol={}"'.format(subvol),
-                options
-            )
-            content = content[:match.start(2)] + new_options + content[match.end(2):]
+    except (subprocess.TimeoutExpired, OSError):
+        return None
+    path = result.stdout.strip()
+    if result.returncode != 0 or not path:
+        return None
+
+    path = os.path.realpath(path)
+    try:
+        with open(os.path.join(path, ".git-revision"), "r") as f:
+            rev = f.read().strip()
+        if rev:
+            return rev
+    except OSError:
+        pass
+    return path
+
+
+def load_unfree_cache(cache_path):
+    """Load the {revision: {package: unfree}} cache, or {} if unreadable."""
+    try:
+        with open(cache_path, "r") as f:
+            cache = json.load(f)
+        if isinstance(cache, dict):
+            return cache
+    except (OSError, ValueError):
+        pass
+    return {}
+
+
+def save_unfree_cache(cache_path, cache):
+    """Write the unfree-status cache, replacing the old file atomically."""
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        write_atomic(cache_path, json.dumps(cache, indent=2, sort_keys=True))
+    except OSError as e:
+        libcalamares.utils.debug(
+            "Could not write unfree cache {}: {}".format(cache_path, e))
 
-    # For root mount point, remove subvol= entirely (use top-level)
-    pattern = r'(fileSystems\."/"\s*=\s*\{[^}]*options\s*=\s*\[)([^\]]*)(])'
-    match = re.search(pattern, content, re.DOTALL)
-    if match:
-        options = match.group(2)
-        new_options = re.sub(r'\s*"subvol=[^"]*"\s*', " ", options)
-        content = content[:match.start(2)] + new_options + content[match.end(2):]
 
-    with open(hw_config_path, "w") as f:
-        f.write(content)
+# Attribute paths as nixos-generate-config writes them, e.g.
+# config.boot.kernelPackages.broadcom_sta
+PACKAGE_ATTR_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_'-]*(\.[A-Za-z_][A-Za-z0-9_'-]*)*$")
 
 
-def strip_unfree_hw_packages(hw_config_path):
+def eval_unfree_status(packages):
+    """
+    Evaluate meta.unfree for all packages in a single nix-instantiate call.
+
+    Returns {package: True/False}. Packages that can't be resolved or
+    evaluated are left out, so callers keep them.
+    """
+    packages = [p for p in packages if PACKAGE_ATTR_RE.match(p)]
+    if not packages:
+        return {}
+
+    # hardware-configuration.nix refers to kernel module packages through
+    # config.boot.kernelPackages; resolve that against the default kernel.
+    checks = "\n".join(
+        '  "{}" = check [ {} ];'.format(
+            pkg, " ".join('"{}"'.format(a) for a in pkg.split(".")))
+        for pkg in packages
+    )
+    expr = """\
+let
+  pkgs = import <nixpkgs> { };
+  scope = pkgs // {
+    inherit pkgs;
+    config.boot.kernelPackages = pkgs.linuxPackages;
+  };
+  check = path:
+    let
+      pkg = pkgs.lib.attrByPath path null scope;
+      unfree = builtins.tryEval (pkg.meta.unfree or false);
+    in
+    if pkg == null || !unfree.success then null else unfree.value;
+in
+{
+""" + checks + "\n}\n"
+
+    try:
+        result = run_command(
+            "nix-instantiate (unfree)",
+            ["nix-instantiate", "--eval", "--strict", "--json", "-E", expr],
+            capture_output=True, text=True, timeout=60
+        )
+        if result.returncode != 0:
+            libcalamares.utils.debug(
+                "Unfree evaluation failed: {}".format(result.stderr.strip()))
+            return {}
+        statuses = json.loads(result.stdout)
+    except (subprocess.TimeoutExpired, OSError, ValueError) as e:
+        libcalamares.utils.debug("Unfree evaluation failed: {}".format(e))
+        return {}
+
+    return {pkg: unfree for pkg, unfree in statuses.items()
+            if isinstance(unfree, bool)}
+
+
+@hardware_transform
+def strip_unfree_hw_packages(hw, context):
     """
     Remove unfree packages from boot.extraModulePackages in
     hardware-configuration.nix when unfree is disabled.
+
+    Unfree status is looked up in a cache keyed by nixpkgs revision and
+    package attribute; only cache misses are evaluated, all in one batch.
     """
-    if not os.path.exists(hw_config_path):
+    if context.get("allowUnfree"):
+        return
+    packages = hw.boot_lists.get("boot.extraModulePackages")
+    if not packages:
         return
 
-    with open(hw_config_path, "r") as f:
-        content = f.read()
+    cache_path = context.get("unfreeCache") or DEFAULT_UNFREE_CACHE
+    revision = nixpkgs_revision()
+    cache = load_unfree_cache(cache_path) if revision else {}
+    known = cache.get(revision, {}) if revision else {}
+
+    missing = [p for p in packages if p not in known]
+    if missing:
+        evaluated = eval_unfree_status(missing)
+        known.update(evaluated)
+        if revision and evaluated:
+            cache[revision] = known
+            save_unfree_cache(cache_path, cache)
+    libcalamares.utils.debug(
+        "Unfree status: {} cached, {} evaluated".format(
+            len(packages) - len(missing), len(missing)))
+
+    # If we can't determine a package's status, keep it
+    hw.boot_lists["boot.extraModulePackages"] = [
+        p for p in packages if not known.get(p, False)]
+
+
+def network_available(url=NETWORK_CHECK_URL, timeout=5):
+    """Return True if the binary cache answers within timeout seconds."""
+    try:
+        with urllib.request.urlopen(url, timeout=timeout):
+            return True
+    except (OSError, ValueError):
+        return False
 
-    # Find boot.extraModulePackages line
-    pattern = r'boot\.extraModulePackages\s*=\s*\[([^\]]*)\]'
-    match = re.search(pattern, content)
-    if not match:
-        return
 
-    packages_str = match.group(1).strip()
-    if not packages_str:
-        return
+def load_source_pin(pin_path):
+    """
+    Load the cairn revision the ISO was built from, or None.
+    The pin has rev, narHash and lastModified; all three are needed for
+    nix to use the source already in the live store instead of fetching.
+    """
+    try:
+        with open(pin_path, "r") as f:
+            pin = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not all(pin.get(k) for k in ("rev", "narHash", "lastModified")):
+        return None
+    return pin
+
+
+def resolve_install_mode(mode, pin):
+    """
+    Resolve the configured installMode to "online" or "offline" and
+    whether to pin cairn to the ISO revision.
+    Returns (mode, use_pin).
+    """
+    if mode == "offline":
+        return "offline", pin is not None
+    if mode == "online":
+        return "online", False
+    # auto: prefer the live medium, but only go fully offline when the
+    # network caches can't be reached
+    if network_available():
+        return "online", pin is not None
+    return "offline", pin is not None
+
+
+def flake_lock_command(mode, pin):
+    """Build the nix flake lock command for the resolved install mode."""
+    cmd = ["nix", "flake", "lock"] + NIX_FLAGS
+    if pin:
+        cmd.extend([
+            "--override-input", "cairn",
+            "github:kcalvelli/cairn/{}?narHash={}&lastModified={}".format(
+                pin["rev"], pin["narHash"], pin["lastModified"]),
+        ])
+    if mode == "offline":
+        cmd.append("--offline")
+    return cmd
+
+
+def substituter_options(mode, substituters=None, public_keys=()):
+    """
+    Substituter options for building the system in the resolved install
+    mode. The live store (auto?trusted=1) always comes first, ahead of
+    the network caches; offline mode drops the network caches entirely.
+    In online mode, substituters (URLs as ranked by rank_substituters)
+    replace nix's defaults and are tried in that order.
+    """
+    options = []
+    if mode != "offline" and substituters:
+        # nix orders substituters by priority, not by their position,
+        # so the ranking is passed as explicit priorities (the live
+        # store is 0, ahead of all of them)
+        options.extend(["--option", "substituters", " ".join(
+            "{}?priority={}".format(url, SUBSTITUTER_PRIORITY + i)
+            for i, url in enumerate(substituters))])
+        if public_keys:
+            options.extend(["--extra-trusted-public-keys",
+                            " ".join(public_keys)])
+        # A mirror that stops responding mid-install fails the transfer
+        # quickly and nix moves on to the next one for that path
+        options.extend([
+            "--option", "connect-timeout", str(SUBSTITUTER_CONNECT_TIMEOUT),
+            "--option", "stalled-download-timeout",
+            str(SUBSTITUTER_STALL_TIMEOUT),
+        ])
+    options.extend(["--extra-substituters", "auto?trusted=1"])
+    if mode == "offline":
+        options.extend(["--option", "substituters", ""])
+    return options
+
+
+# ─── Substituter selection ────────────────────────────────────────
+# The network caches, including any site-local mirrors in the job
+# configuration, are probed while the flake is locked: nix-cache-info
+# for round-trip latency, then the narinfo and the first PROBE_BYTES of
+# the NAR of a store path every cache should have (the live medium's
+# nix) for throughput. Unreachable caches are dropped and the rest are
+# passed to nix build fastest first.
+
+# The caches the cairn modules configure (see docs/BINARY_CACHE.md)
+DEFAULT_SUBSTITUTERS = [
+    "https://cache.nixos.org",
+    "https://cairn.cachix.org",
+    "https://niri.cachix.org",
+    "https://brave-previews.cachix.org",
+]
+DEFAULT_TRUSTED_PUBLIC_KEYS = [
+    "cache.nixos.org-1:6NCHdD59X431kS1gBOk6429S9g0f1NXtv+FIsf8Xma0=",
+    "cairn.cachix.org-1:8c7nj72raLM0Q4Fie799J/70D2/5oDd7rxqnOuxObh4=",
+    "niri.cachix.org-1:Wv0OmO7PsuocRKzfDoJ3mulSl7Z6oezYhGhR+3W2964=",
+    "brave-previews.cachix.org-1:9bLSYtgro1rYD4hUzFVASMpsNjWjHvEz11HGB2trAq4=",
+]
+
+# Seconds each probe request may take
+PROBE_TIMEOUT = 3
+# NAR bytes read to estimate a cache's throughput
+PROBE_BYTES = 512 * 1024
+# Size of a typical closure path, for weighing latency against throughput
+TYPICAL_PATH_BYTES = 2 * 1024 * 1024
+# Priority of the fastest substituter; the rest follow in rank order
+SUBSTITUTER_PRIORITY = 10
+# nix connect-timeout and stalled-download-timeout during the build
+SUBSTITUTER_CONNECT_TIMEOUT = 5
+SUBSTITUTER_STALL_TIMEOUT = 30
+
+
+def probe_store_hash():
+    """Hash part of the live medium's nix store path, or None."""
+    nix = shutil.which("nix")
+    if not nix:
+        return None
+    parts = os.path.realpath(nix).split("/")
+    if len(parts) < 4 or parts[1:3] != ["nix", "store"]:
+        return None
+    return parts[3].split("-", 1)[0]
+
+
+def _narinfo_field(text, name):
+    for line in text.splitlines():
+        key, _, value = line.partition(":")
+        if key == name:
+            return value.strip()
+    return None
+
+
+def probe_substituter(url, store_hash=None, timeout=PROBE_TIMEOUT):
+    """
+    Measure one binary cache. Returns {"url", "latency", "throughput"}:
+    seconds to fetch nix-cache-info (None if unreachable or not a nix
+    cache) and bytes/second reading store_hash's NAR (None if the cache
+    doesn't have it or no store_hash was given).
+    """
+    result = {"url": url, "latency": None, "throughput": None}
+    try:
+        start = time.monotonic()
+        with urllib.request.urlopen(url + "/nix-cache-info",
+                                    timeout=timeout) as response:
+            info = response.read().decode("utf-8", "replace")
+        if _narinfo_field(info, "StoreDir") != "/nix/store":
+            return result
+        result["latency"] = time.monotonic() - start
+        if not store_hash:
+            return result
+
+        with urllib.request.urlopen("{}/{}.narinfo".format(url, store_hash),
+                                    timeout=timeout) as response:
+            narinfo = response.read().decode("utf-8", "replace")
+        nar_url = _narinfo_field(narinfo, "URL")
+        if not nar_url:
+            return result
+        start = time.monotonic()
+        with urllib.request.urlopen("{}/{}".format(url, nar_url),
+                                    timeout=timeout) as response:
+            received = len(response.read(PROBE_BYTES))
+        elapsed = time.monotonic() - start
+        if received and elapsed > 0:
+            result["throughput"] = received / elapsed
+    except (OSError, ValueError):
+        pass
+    return result
+
+
+def rank_substituters(substituters, probes):
+    """
+    Order substituter URLs by the estimated time to fetch a typical
+    path, dropping the unreachable ones. Caches without the probe path are
+    assumed to be as slow as the slowest one measured. If none could be
+    reached the configured order is kept, and nix sorts it out.
+    """
+    by_url = {p["url"]: p for p in probes}
+    reachable = [url for url in substituters
+                 if by_url.get(url, {}).get("latency") is not None]
+    if not reachable:
+        return list(substituters)
+    measured = [by_url[url]["throughput"] for url in reachable
+                if by_url[url]["throughput"]]
+    slowest = min(measured) if measured else None
+
+    def cost(url):
+        probe = by_url[url]
+        throughput = probe["throughput"] or slowest
+        return probe["latency"] + (
+            TYPICAL_PATH_BYTES / throughput if throughput else 0)
+
+    return sorted(reachable, key=cost)
+
+
+def describe_probe(probe):
+    """One log line for a probe_substituter result."""
+    if probe["latency"] is None:
+        return "Substituter {}: unreachable".format(probe["url"])
+    return "Substituter {}: {:.0f} ms, {}".format(
+        probe["url"], probe["latency"] * 1000,
+        "{:.1f} MiB/s".format(probe["throughput"] / 2**20)
+        if probe["throughput"] else "no probe path")
+
+
+def probe_substituters(substituters, store_hash=None):
+    """Probe all substituters concurrently; returns their results in order."""
+    if not substituters:
+        return []
+    with ThreadPoolExecutor(max_workers=len(substituters)) as pool:
+        return list(pool.map(
+            lambda url: probe_substituter(url, store_hash), substituters))
+
+
+def start_probing(job_config, mode):
+    """
+    Start probing the job's configured substituters in the background
+    (online mode only). Returns (substituters, future or None).
+    """
+    substituters = [url.rstrip("/") for url in job_config.get(
+        "substituters", DEFAULT_SUBSTITUTERS) or []]
+    if mode != "online" or not substituters:
+        return substituters, None
+    pool = ThreadPoolExecutor(max_workers=1)
+    probing = pool.submit(probe_substituters, substituters, probe_store_hash())
+    pool.shutdown(wait=False)
+    return substituters, probing
+
+
+def finish_probing(substituters, probing):
+    """Wait for start_probing; returns (ranked substituters, probes)."""
+    probes = probing.result()
+    ranked = rank_substituters(substituters, probes)
+    for probe in probes:
+        libcalamares.utils.debug(describe_probe(probe))
+    libcalamares.utils.debug("Substituter order: {}".format(", ".join(ranked)))
+    return ranked, probes
+
+
+def job_substituter_options(job_config, mode, substituters):
+    """substituter_options with the job's extra trusted keys."""
+    return substituter_options(
+        mode, substituters, DEFAULT_TRUSTED_PUBLIC_KEYS
+        + (job_config.get("trustedPublicKeys") or []))
+
+
+# ─── Build parallelism ────────────────────────────────────────────
+# The live medium's /nix is an overlay on tmpfs, so the default build
+# dir is RAM. Builds are moved to the target disk when RAM is short.
+
+LIVE_BUILD_DIR = "/nix/var/nix/builds"
+TARGET_BUILD_DIR = "nix/var/nix/builds"
+
+GIB = 1024 ** 3
+# RAM kept free for the live session and Calamares itself
+RESERVED_MEMORY = 2 * GIB
+# Rough peak memory of one build job in an install closure
+JOB_MEMORY = 1.5 * GIB
+# Scratch space a RAM build dir is expected to need
+BUILD_DIR_MEMORY = 4 * GIB
+# Free space required on the target for builds to go there
+TARGET_BUILD_SPACE = 10 * GIB
+
+
+def read_meminfo(path="/proc/meminfo"):
+    """Return /proc/meminfo as a dict of byte counts."""
+    info = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                key, _, rest = line.partition(":")
+                fields = rest.split()
+                if fields and fields[0].isdigit():
+                    info[key] = int(fields[0]) * 1024
+    except OSError:
+        pass
+    return info
+
+
+def free_space(path):
+    """Bytes available to unprivileged writers at path, or 0."""
+    try:
+        st = os.statvfs(path)
+    except OSError:
+        return 0
+    return st.f_bavail * st.f_frsize
+
+
+def build_tuning(threads, available_memory, target_free, root_mount_point):
+    """
+    Choose nix build parallelism and build dir placement for this machine.
 
-    # Check each package for unfree status via nix-instantiate
-    packages = [p.strip() for p in packages_str.split() if p.strip()]
-    free_packages = []
+    Jobs are capped by memory (JOB_MEMORY each) and split the threads
+    between them: wide machines run several multi-core builds at once,
+    small laptops run one. Returns a dict of nix options plus a "reason"
+    line for the install log.
+    """
+    threads = max(1, threads or os.cpu_count() or 1)
+
+    spare_memory = available_memory - RESERVED_MEMORY
+    ram_build_dir = (spare_memory >= BUILD_DIR_MEMORY + JOB_MEMORY
+                     or target_free < TARGET_BUILD_SPACE)
+    if ram_build_dir:
+        build_dir = LIVE_BUILD_DIR
+        usable = spare_memory - BUILD_DIR_MEMORY
+    else:
+        build_dir = os.path.join(root_mount_point, TARGET_BUILD_DIR)
+        usable = spare_memory
+
+    memory_jobs = max(1, int(usable // JOB_MEMORY))
+    max_jobs = max(1, min(threads // 4, memory_jobs))
+    cores = max(1, threads // max_jobs)
+
+    return {
+        "max-jobs": max_jobs,
+        "cores": cores,
+        # Substitution is network- and decompression-bound; more threads
+        # can keep more downloads in flight.
+        "max-substitution-jobs": max(16, threads),
+        "http-connections": min(128, max(25, threads * 2)),
+        "build-dir": build_dir,
+        "reason": "{} threads, {:.1f} GiB available, {:.1f} GiB free on "
+                  "target, build dir in {}".format(
+                      threads, available_memory / GIB, target_free / GIB,
+                      "RAM" if ram_build_dir else "target"),
+    }
+
+
+def tuning_options(tuning):
+    """nix --option arguments for a build_tuning() result."""
+    options = []
+    for name in ("max-jobs", "cores", "max-substitution-jobs",
+                 "http-connections", "build-dir"):
+        options.extend(["--option", name, str(tuning[name])])
+    return options
+
+
+# ─── Memory profile ───────────────────────────────────────────────
+# zram, /tmp and build limits for the installed system, by detected RAM.
+# Small machines keep /tmp on disk and cap nix builds so they don't
+# thrash; large ones put /tmp in RAM and barely need zram.
+
+# (RAM up to, zram %, zram algorithm, /tmp tmpfs size or None for disk,
+#  systemd-oomd user-slice pressure limit)
+MEMORY_PROFILES = (
+    (8 * GIB, 50, "zstd", None, "40%"),
+    (16 * GIB, 50, "zstd", "50%", "50%"),
+    (64 * GIB, 25, "zstd", "50%", "50%"),
+    (None, 10, "lz4", "75%", "60%"),
+)
+
+# Memory to allow per parallel nix build on the installed system
+NIX_JOB_MEMORY = 2 * GIB
+# Throttle the nix daemon before it starves the desktop, up to this RAM
+DAEMON_MEMORY_HIGH_UP_TO = 16 * GIB
+
+
+def memory_profile(total_bytes, threads=None):
+    """Choose memory settings for a machine with total_bytes of RAM."""
+    for limit, zram_percent, algorithm, tmpfs_size, user_limit in MEMORY_PROFILES:
+        if limit is None or total_bytes <= limit:
+            break
+    profile = {
+        "zramPercent": zram_percent,
+        "zramAlgorithm": algorithm,
+        "tmpfsSize": tmpfs_size,
+        "userPressureLimit": user_limit,
+        "maxJobs": None,
+        "daemonMemoryHigh": None,
+    }
+    jobs = max(1, int(total_bytes // NIX_JOB_MEMORY))
+    if threads and jobs < threads:
+        profile["maxJobs"] = jobs
+    if total_bytes <= DAEMON_MEMORY_HIGH_UP_TO:
+        profile["daemonMemoryHigh"] = "75%"
+    return profile
+
+
+def memory_config_lines(total_bytes, threads=None):
+    """extraConfig lines applying memory_profile()."""
+    profile = memory_profile(total_bytes, threads)
+    lines = [
+        "",
+        "      # Memory profile (detected: {:.0f} GiB RAM)".format(
+            total_bytes / GIB),
+        "      cairn.system.performance.zramPercent = {};".format(
+            profile["zramPercent"]),
+        '      cairn.system.performance.zramAlgorithm = "{}";'.format(
+            profile["zramAlgorithm"]),
+        "      cairn.system.performance.tmpOnTmpfs = {};".format(
+            nix_bool(profile["tmpfsSize"])),
+    ]
+    if profile["tmpfsSize"]:
+        lines.append('      cairn.system.performance.tmpfsSize = "{}";'.format(
+            profile["tmpfsSize"]))
+    lines.append('      system.memory.oomd.userPressureLimit = "{}";'.format(
+        profile["userPressureLimit"]))
+    if profile["maxJobs"]:
+        lines.append("      nix.settings.max-jobs = {};".format(
+            profile["maxJobs"]))
+    if profile["daemonMemoryHigh"]:
+        lines.append(
+            '      systemd.services.nix-daemon.serviceConfig.MemoryHigh = "{}";'
+            .format(profile["daemonMemoryHigh"]))
+    return lines
+
+# ─── Target storage ───────────────────────────────────────────────
+# Which disks the installed system actually lives on, found from the
+# mounts under rootMountPoint and resolved through partitions and
+# dm/md/LUKS layers in sysfs. Drives hasSSD, I/O schedulers and mount
+# options for the target instead of whatever disks the live system sees.
+
+MOUNTINFO = "/proc/self/mountinfo"
+SYSFS_ROOT = "/sys"
+TARGET_MOUNTS = ("/", "/nix", "/home")
+
+# Slowest first: a filesystem spanning several disks gets the worst class
+STORAGE_CLASSES = ("hdd", "ssd", "nvme")
+
+# udev rules picking an I/O scheduler per class: none for NVMe (the
+# device queues itself), mq-deadline for SATA SSDs, bfq for spinning disks
+IO_SCHEDULER_RULES = {
+    "nvme": 'ACTION=="add|change", KERNEL=="nvme[0-9]*n[0-9]*", '
+            'ATTR{queue/scheduler}="none"',
+    "ssd": 'ACTION=="add|change", KERNEL=="sd[a-z]*|mmcblk[0-9]*", '
+           'ATTR{queue/rotational}=="0", ATTR{queue/scheduler}="mq-deadline"',
+    "hdd": 'ACTION=="add|change", KERNEL=="sd[a-z]*", '
+           'ATTR{queue/rotational}=="1", ATTR{queue/scheduler}="bfq"',
+}
+
+
+def _unescape_mountinfo(field):
+    return re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), field)
+
+
+def parse_mountinfo(path=MOUNTINFO):
+    """Return {mount point: {"devno", "fsType", "source"}} from mountinfo."""
+    mounts = {}
+    try:
+        with open(path, "r") as f:
+            for line in f:
+                fields = line.split()
+                try:
+                    sep = fields.index("-", 6)
+                except ValueError:
+                    continue
+                # Later entries shadow earlier ones at the same mount point
+                mounts[_unescape_mountinfo(fields[4])] = {
+                    "devno": fields[2],
+                    "fsType": fields[sep + 1],
+                    "source": _unescape_mountinfo(fields[sep + 2]),
+                }
+    except (OSError, IndexError):
+        pass
+    return mounts
+
+
+def _read_text(path):
+    try:
+        with open(path, "r") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def block_device_name(mount, sysfs_root=SYSFS_ROOT):
+    """Kernel name (nvme0n1p2, dm-0, ...) of the device behind a mount."""
+    class_block = os.path.join(sysfs_root, "class/block")
+    source = mount["source"]
+    if source.startswith("/dev/"):
+        source = os.path.realpath(source)
+        if source.startswith("/dev/mapper/"):
+            dm_name = os.path.basename(source)
+            for name in os.listdir(class_block):
+                dm = os.path.join(class_block, name, "dm/name")
+                if name.startswith("dm-") and _read_text(dm) == dm_name:
+                    return name
+        name = os.path.basename(source)
+        if os.path.isdir(os.path.join(class_block, name)):
+            return name
+
+    # btrfs reports an anonymous devno, but other filesystems don't
+    dev = os.path.realpath(
+        os.path.join(sysfs_root, "dev/block", mount["devno"]))
+    if os.path.isdir(dev):
+        return os.path.basename(dev)
+    return None
 
-    for pkg in packages:
+
+def backing_disks(name, sysfs_root=SYSFS_ROOT):
+    """Whole disks under block device name, through partitions and slaves."""
+    dev = os.path.realpath(os.path.join(sysfs_root, "class/block", name))
+    if os.path.exists(os.path.join(dev, "partition")):
+        # A partition's sysfs directory sits inside its disk's
+        return backing_disks(os.path.basename(os.path.dirname(dev)),
+                             sysfs_root)
+    try:
+        slaves = sorted(os.listdir(os.path.join(dev, "slaves")))
+    except OSError:
+        slaves = []
+    if not slaves:
+        return [name]
+    disks = []
+    for slave in slaves:
+        for disk in backing_disks(slave, sysfs_root):
+            if disk not in disks:
+                disks.append(disk)
+    return disks
+
+
+def storage_class(disk, sysfs_root=SYSFS_ROOT):
+    """Classify a whole disk as "nvme", "ssd" or "hdd"."""
+    if disk.startswith("nvme"):
+        return "nvme"
+    rotational = _read_text(
+        os.path.join(sysfs_root, "class/block", disk, "queue/rotational"))
+    return "hdd" if rotational == "1" else "ssd"
+
+
+def target_storage(root_mount_point, mountinfo=MOUNTINFO,
+                   sysfs_root=SYSFS_ROOT):
+    """
+    Map each of TARGET_MOUNTS that has its own filesystem under
+    root_mount_point to {"fsType", "disks", "class"}. Mounts that can't
+    be resolved to disks are left out.
+    """
+    mounts = parse_mountinfo(mountinfo)
+    root = os.path.normpath(root_mount_point)
+    storage = {}
+    for target in TARGET_MOUNTS:
+        path = os.path.normpath(root + target) if target != "/" else root
+        mount = mounts.get(path)
+        if mount is None and target == "/":
+            # Not a mount point itself: use the mount containing it
+            parents = [p for p in mounts
+                       if root == p or root.startswith(p.rstrip("/") + "/")]
+            mount = mounts[max(parents, key=len)] if parents else None
+        if mount is None:
+            continue
+        name = block_device_name(mount, sysfs_root)
+        if name is None:
+            continue
+        disks = backing_disks(name, sysfs_root)
+        classes = [storage_class(d, sysfs_root) for d in disks]
+        storage[target] = {
+            "fsType": mount["fsType"],
+            "disks": disks,
+            "class": min(classes, key=STORAGE_CLASSES.index),
+        }
+    return storage
+
+
+@hardware_transform
+def tune_mount_options(hw, context):
+    """
+    Add noatime to the target's own filesystems, and discard=async for
+    btrfs on flash (other filesystems rely on the periodic fstrim).
+    """
+    for mount, info in (context.get("storage") or {}).items():
+        fs = hw.filesystems.get(mount)
+        if fs is None:
+            continue
+        _add_noatime(fs)
+        if (fs.fs_type == "btrfs" and info["class"] != "hdd"
+                and not any("discard" in o for o in fs.options)):
+            fs.options.append("discard=async")
+
+
+def _process_running(pid):
+    """True if pid exists and isn't a zombie waiting to be reaped."""
+    try:
+        with open("/proc/{}/stat".format(pid), "r") as f:
+            # state follows the parenthesised command name
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except (OSError, IndexError):
+        return False
+
+
+def wait_for_prefetch(prefetch, timeout=300, report=None, cancelled=None):
+    """
+    Wait for the flake prefetch started by cairndetect to finish.
+
+    report(fraction), if given, is called with the share of timeout
+    waited so far. Returns True if the prefetch succeeded, False if it
+    failed, vanished, is still running after timeout seconds or the
+    cancelled event was set; either way the caller then locks normally.
+    """
+    status_path = os.path.join(prefetch["dir"], "status")
+    start = time.monotonic()
+    logged = 0
+    while True:
         try:
-            result = subprocess.run(
-                ["nix-instantiate", "--eval", "-E",
-                 "with import <nixpkgs> {{}}; ({}).meta.unfree or false".format(pkg)],
-                capture_output=True, text=True, timeout=30
-            )
-            is_unfree = result.stdout.strip() == "true"
-            if not is_unfree:
-                free_packages.append(pkg)
-        except (subprocess.TimeoutExpired, Exception):
-            # If we can't determine, keep the package
-            free_packages.append(pkg)
+            with open(status_path, "r") as f:
+                status = f.read().strip()
+            libcalamares.utils.debug(
+                "Prefetch of {} finished with status {} ({:.0f}s since "
+                "detection)".format(prefetch["ref"], status,
+                                    time.time() - prefetch["started"]))
+            return status == "0"
+        except OSError:
+            pass
+
+        waited = time.monotonic() - start
+        if not _process_running(prefetch["pid"]):
+            libcalamares.utils.debug("Prefetch exited without a status")
+            return False
+        if waited >= timeout:
+            libcalamares.utils.debug(
+                "Prefetch still running after {}s, locking anyway".format(
+                    timeout))
+            return False
+        if cancelled is not None and cancelled.is_set():
+            return False
+        if waited - logged >= 10:
+            logged = waited
+            libcalamares.utils.debug(
+                "Waiting for flake prefetch ({:.0f}s)...".format(waited))
+
+        if report:
+            report(waited / timeout)
+        time.sleep(0.5)
+
+
+def _resolve_in_root(root, path):
+    """Follow a chain of symlinks inside root, returning the final path."""
+    for _ in range(40):
+        full = os.path.join(root, path.lstrip("/"))
+        if not os.path.islink(full):
+            return path
+        target = os.readlink(full)
+        path = target if target.startswith("/") else os.path.join(
+            os.path.dirname(path), target)
+    return path
+
+
+def _path_info(args):
+    """Run nix path-info --json and return {path: info}."""
+    result = run_command(
+        "nix path-info",
+        ["nix", "path-info", "--json"] + NIX_FLAGS + args,
+        capture_output=True, text=True, timeout=120
+    )
+    if result.returncode != 0:
+        return {}
+    infos = json.loads(result.stdout)
+    # Older nix returns a list of objects, newer an object keyed by path
+    if isinstance(infos, list):
+        return {i["path"]: i for i in infos if "path" in i}
+    return {p: i for p, i in infos.items() if i}
 
-    new_packages_str = " ".join(free_packages)
-    content = content[:match.start(1)] + " " + new_packages_str + " " + content[match.end(1):]
 
-    with open(hw_config_path, "w") as f:
-        f.write(content)
+def store_path_sources(root_mount_point):
+    """
+    Account for where the installed system's closure came from.
 
+    Returns {"local": {"paths", "bytes"}, "remote": {"paths", "bytes"}}
+    where local counts paths also present in the live medium's store and
+    remote counts everything fetched from the network or built.
+    Returns None if the closure can't be inspected.
+    """
+    toplevel = _resolve_in_root(root_mount_point,
+                                "/nix/var/nix/profiles/system")
+    if not toplevel.startswith("/nix/store/"):
+        return None
+    try:
+        closure = _path_info(["--store", root_mount_point, "-r", toplevel])
+        if not closure:
+            return None
+        validity = run_command(
+            "nix-store --check-validity",
+            ["nix-store", "--check-validity", "--print-invalid"]
+            + list(closure),
+            capture_output=True, text=True, timeout=120
+        )
+    except (subprocess.TimeoutExpired, OSError, ValueError):
+        return None
+    invalid = set(validity.stdout.split())
+
+    sources = {"local": {"paths": 0, "bytes": 0},
+               "remote": {"paths": 0, "bytes": 0}}
+    for path, info in closure.items():
+        origin = sources["remote" if path in invalid else "local"]
+        origin["paths"] += 1
+        origin["bytes"] += info.get("narSize", 0)
+    return sources
+
+
+# ─── nix internal-json log parsing ────────────────────────────────
+# nix build --log-format internal-json writes one "@nix {...}" event per
+# line on stderr: activities start and stop, and report results
+# (progress, expected totals, build log lines) against their id.
+
+# Activity types (nix/src/libutil/logging.hh)
+ACT_COPY_PATH = 100
+ACT_FILE_TRANSFER = 101
+ACT_COPY_PATHS = 103
+ACT_BUILDS = 104
+ACT_BUILD = 105
+ACT_SUBSTITUTE = 108
+
+# Result types
+RES_BUILD_LOG_LINE = 101
+RES_PROGRESS = 105
+RES_SET_EXPECTED = 106
+RES_POST_BUILD_LOG_LINE = 107
+
+# nix log levels up to and including this one are shown to the user
+LOG_LEVEL_INFO = 3
+
+
+class NixProgress:
+    """
+    Track a nix build from its internal-json log and derive overall
+    progress: store paths copied and derivations built out of the
+    expected totals, and bytes downloaded out of the expected download
+    size.
+    """
 
-def run():
-    """Main Calamares job entry point."""
-    gs = libcalamares.globalstorage
-    root_mount_point = gs.value("rootMountPoint")
+    def __init__(self):
+        self.activities = {}
+        self.copied = [0, 0]
+        self.built = [0, 0]
+        self.download_expected = 0
+        self.transfers = {}
+        self.downloaded = 0
+        self.active_builds = {}
+        self.samples = collections.deque()
+
+    def feed(self, line):
+        """
+        Process one line of output. Returns a human-readable message for
+        log messages and build output, or None for progress events.
+        """
+        if not line.startswith("@nix "):
+            return line
+        try:
+            event = json.loads(line[5:])
+        except ValueError:
+            return line
+
+        action = event.get("action")
+        if action == "msg":
+            if event.get("level", 0) <= LOG_LEVEL_INFO:
+                return event.get("msg", "")
+        elif action == "start":
+            act_id = event.get("id")
+            act_type = event.get("type")
+            self.activities[act_id] = act_type
+            if act_type == ACT_BUILD:
+                self.active_builds[act_id] = event.get("text", "")
+        elif action == "stop":
+            act_id = event.get("id")
+            self.activities.pop(act_id, None)
+            self.active_builds.pop(act_id, None)
+        elif action == "result":
+            return self._result(event)
+        return None
+
+    def _result(self, event):
+        act_id = event.get("id")
+        res_type = event.get("type")
+        fields = event.get("fields") or []
+        act_type = self.activities.get(act_id)
+
+        if res_type in (RES_BUILD_LOG_LINE, RES_POST_BUILD_LOG_LINE) and fields:
+            return str(fields[0])
+        if res_type == RES_PROGRESS and len(fields) >= 2:
+            done, expected = fields[0], fields[1]
+            if act_type == ACT_COPY_PATHS:
+                self.copied = [done, expected]
+            elif act_type == ACT_BUILDS:
+                self.built = [done, expected]
+            elif act_type == ACT_FILE_TRANSFER:
+                # Running total, so readers on other threads never have
+                # to iterate transfers while it is being updated.
+                self.downloaded += done - self.transfers.get(act_id, 0)
+                self.transfers[act_id] = done
+                self._sample()
+        elif res_type == RES_SET_EXPECTED and len(fields) >= 2:
+            if fields[0] == ACT_FILE_TRANSFER:
+                self.download_expected = fields[1]
+        return None
+
+    def _sample(self):
+        now = time.monotonic()
+        self.samples.append((now, self.downloaded))
+        # Keep a 10 second window for throughput
+        while self.samples and now - self.samples[0][0] > 10:
+            self.samples.popleft()
+
+    def throughput(self):
+        """Download rate in bytes/second over the last few seconds."""
+        if len(self.samples) < 2:
+            return 0.0
+        (t0, b0), (t1, b1) = self.samples[0], self.samples[-1]
+        return (b1 - b0) / (t1 - t0) if t1 > t0 else 0.0
+
+    def fraction(self):
+        """Overall progress in [0, 1]."""
+        units_done = self.copied[0] + self.built[0]
+        units_expected = self.copied[1] + self.built[1]
+        parts = []
+        if units_expected:
+            parts.append(units_done / units_expected)
+        if self.download_expected:
+            parts.append(min(self.downloaded / self.download_expected, 1.0))
+        if not parts:
+            return 0.0
+        return sum(parts) / len(parts)
+
+    def summary(self):
+        """One-line status for the install log."""
+        return ("{:.0%}: {}/{} paths, {}/{} builds, {:.1f}/{:.1f} MiB "
+                "at {:.1f} MiB/s, building: {}".format(
+                    self.fraction(), self.copied[0], self.copied[1],
+                    self.built[0], self.built[1],
+                    self.downloaded / 2**20, self.download_expected / 2**20,
+                    self.throughput() / 2**20,
+                    ", ".join(tuple(self.active_builds.values()))
+                    or "nothing"))
+
+
+# ─── Log pump ─────────────────────────────────────────────────────
+# nix build emits tens of thousands of log lines. They are drained on a
+# reader thread so a slow UI never stalls nix, forwarded to Calamares in
+# rate-limited batches, and kept in full on the target.
+
+LOG_DIR = "var/log/cairn-install"
+# Lines kept for the error message if the build fails
+LOG_TAIL_LINES = 50
+# Lines forwarded to the Calamares log per PROGRESS_INTERVAL
+LOG_BATCH_LINES = 200
+
+
+class LogPump:
+    """
+    Reads a process's log stream on a background thread, feeding each
+    line to parser and the raw stream to a gzip file at log_path. Parsed
+    messages are queued for flush() and the most recent kept in tail.
+    """
 
-    if not root_mount_point:
-        return ("Failed to find mount point",
-                "globalstorage does not contain a rootMountPoint")
+    def __init__(self, stream, parser, log_path=None):
+        self.stream = stream
+        self.parser = parser
+        self.log_path = log_path
+        self.tail = collections.deque(maxlen=LOG_TAIL_LINES)
+        self.lines = 0
+        self._pending = []
+        self._dropped = 0
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._drain, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _drain(self):
+        log = None
+        if self.log_path:
+            try:
+                log = gzip.open(self.log_path, "wt", compresslevel=6)
+            except OSError as e:
+                libcalamares.utils.debug(
+                    "Cannot write {}: {}".format(self.log_path, e))
+        try:
+            for line in self.stream:
+                self.lines += 1
+                if log is not None:
+                    log.write(line)
+                message = self.parser.feed(line.rstrip("\n"))
+                if message is None:
+                    continue
+                self.tail.append(message)
+                with self._lock:
+                    if len(self._pending) < LOG_BATCH_LINES:
+                        self._pending.append(message)
+                    else:
+                        self._dropped += 1
+        finally:
+            if log is not None:
+                log.close()
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds; True while the stream is open."""
+        self._thread.join(timeout)
+        return self._thread.is_alive()
+
+    def flush(self, prefix):
+        """Send queued messages to the Calamares log as one batch."""
+        with self._lock:
+            pending, self._pending = self._pending, []
+            dropped, self._dropped = self._dropped, 0
+        if dropped:
+            pending.append("({} more lines in the full log)".format(dropped))
+        if pending:
+            libcalamares.utils.debug(
+                "\n".join(prefix + message for message in pending))
+
+
+def write_log(root_mount_point, name, text):
+    """Write a compressed command log to LOG_DIR on the target."""
+    path = os.path.join(root_mount_point, LOG_DIR, name + ".log.gz")
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with gzip.open(path, "wt") as f:
+            f.write(text)
+    except OSError as e:
+        libcalamares.utils.debug("Cannot write {}: {}".format(path, e))
 
-    # ─── Read globalstorage ─────────────────────────────────────
+
+# ─── Template rendering ───────────────────────────────────────────
+
+TEMPLATE_MARKER = re.compile(r"@@(\w+)@@")
+
+
+class Template:
+    """
+    A template split once into literal text and @@key@@ slots, so that
+    rendering is a single join instead of a rescan per variable.
+    """
+
+    def __init__(self, text):
+        parts = TEMPLATE_MARKER.split(text)
+        self.literals = parts[0::2]
+        self.keys = parts[1::2]
+
+    def render(self, variables, unresolved=None):
+        """
+        Fill the slots from variables. Slots without a value are left as
+        @@key@@ and their keys added to the unresolved set, if given.
+        """
+        out = [self.literals[0]]
+        for key, literal in zip(self.keys, self.literals[1:]):
+            if key in variables:
+                out.append(str(variables[key]))
+            else:
+                out.append("@@{}@@".format(key))
+                if unresolved is not None:
+                    unresolved.add(key)
+            out.append(literal)
+        return "".join(out)
+
+
+_compiled_templates = {}
+
+
+def render(template, variables, unresolved=None):
+    """Substitute @@key@@ markers in template with variables."""
+    compiled = _compiled_templates.get(template)
+    if compiled is None:
+        compiled = _compiled_templates[template] = Template(template)
+    return compiled.render(variables, unresolved)
+
+
+def flake_variables(hostnames):
+    """Variables for cfg_flake listing each of hostnames."""
+    return {
+        "description": "NixOS configuration for {}".format(
+            ", ".join(hostnames)),
+        "host_entries": "\n".join(
+            '        {0} = mkHost "{0}";'.format(hostname)
+            for hostname in hostnames),
+    }
+
+
+def write_host(nixos_dir, variables, unresolved=None):
+    """
+    Write hosts/<hostname>.nix and users/<username>.nix under nixos_dir.
+    Returns the host's hardware directory (hosts/<hostname>).
+    """
+    hostname = variables["hostname"]
+    hosts_dir = os.path.join(nixos_dir, "hosts")
+    host_hw_dir = os.path.join(hosts_dir, hostname)
+    users_dir = os.path.join(nixos_dir, "users")
+
+    os.makedirs(host_hw_dir, exist_ok=True)
+    os.makedirs(users_dir, exist_ok=True)
+
+    with open(os.path.join(hosts_dir, "{}.nix".format(hostname)), "w") as f:
+        f.write(render(cfg_host, variables, unresolved))
+    with open(os.path.join(users_dir, "{}.nix".format(variables["username"])), "w") as f:
+        f.write(render(cfg_user, variables, unresolved))
+
+    return host_hw_dir
+
+
+def write_flake(nixos_dir, variables, unresolved=None):
+    """
+    Write flake.nix, hosts/<hostname>.nix and users/<username>.nix under
+    nixos_dir. Returns the host's hardware directory (hosts/<hostname>).
+    """
+    host_hw_dir = write_host(nixos_dir, variables, unresolved)
+    with open(os.path.join(nixos_dir, "flake.nix"), "w") as f:
+        f.write(render(cfg_flake, flake_variables([variables["hostname"]]),
+                       unresolved))
+    return host_hw_dir
+
+
+# Written next to hardware.nix so tooling and reinstalls can read what
+# cairndetect found instead of probing the machine again
+HARDWARE_PROFILE = "hardware-profile.json"
+
+
+def write_hardware_profile(host_hw_dir, profile):
+    """Save the cairndetect hardware profile to hosts/<hostname>/."""
+    path = os.path.join(host_hw_dir, HARDWARE_PROFILE)
+    try:
+        write_atomic(path, json.dumps(profile, indent=2, sort_keys=True) + "\n")
+    except OSError as e:
+        libcalamares.utils.debug("Cannot write {}: {}".format(path, e))
+
+
+# ─── Speculative closure build ────────────────────────────────────
+# cairndetect can start building the most likely system (detected
+# hardware, standard profile, no optional modules) while the user is on
+# the show pages. Whatever it realises lands in the live store, which
+# nixos-install already substitutes from, so the real install only has
+# to build the difference.
+
+SPECULATIVE_DIR = "/run/cairn-installer/speculative"
+
+# Answers assumed for the speculative build, on top of detected hardware
+SPECULATIVE_ANSWERS = {
+    "hostname": "cairn-speculative",
+    "username": "nixos",
+    "fullname": "",
+    "locationRegion": "Etc",
+    "locationZone": "UTC",
+    "cairn_homeProfile": "standard",
+}
+
+# Variables and extraConfig settings that only name, localise or tune
+# things; they barely change the closure, so they are left out of the
+# speculative key (the target disks aren't known until partitioning)
+IDENTITY_VARIABLES = ("hostname", "username", "fullname", "timezone")
+IDENTITY_SETTINGS = ("services.xserver.xkb.", "services.udev.extraRules")
+
+# Stands in for the generated hardware configuration during evaluation
+speculative_hardware = """\
+{ lib, ... }:
+{
+  fileSystems."/" = {
+    device = "/dev/disk/by-label/nixos";
+    fsType = "ext4";
+  };
+  nixpkgs.hostPlatform = lib.mkDefault "x86_64-linux";
+}
+"""
+
+
+def speculative_key(variables):
+    """Hash the variables that decide the system closure."""
+    relevant = {k: v for k, v in variables.items()
+                if k not in IDENTITY_VARIABLES}
+    relevant["extra_config"] = "\n".join(
+        line for line in relevant.get("extra_config", "").splitlines()
+        if not line.strip().startswith(IDENTITY_SETTINGS))
+    return hashlib.sha256(
+        json.dumps(relevant, sort_keys=True).encode()).hexdigest()
+
+
+def start_speculative_build(value, lock_options=None,
+                            state_dir=SPECULATIVE_DIR):
+    """
+    Render the most likely configuration into state_dir and start
+    building its toplevel in the background.
+
+    value looks up detected answers like globalstorage.value;
+    lock_options are extra nix flake lock arguments (e.g. the ISO pin).
+    Returns the state to record in globalstorage, or None.
+    """
+    def speculative_value(key):
+        if key in SPECULATIVE_ANSWERS:
+            return SPECULATIVE_ANSWERS[key]
+        if key.startswith("cairn_enable") or key == "nixos_allow_unfree":
+            return False
+        return value(key)
+
+    variables = build_variables(speculative_value)
+    hostname = variables["hostname"]
+
+    try:
+        shutil.rmtree(state_dir, ignore_errors=True)
+        host_hw_dir = write_flake(state_dir, variables)
+        with open(os.path.join(host_hw_dir, "hardware.nix"), "w") as f:
+            f.write(speculative_hardware)
+
+        lock = ["nix", "flake", "lock"] + NIX_FLAGS + (lock_options or [])
+        build = ["nix", "build"] + NIX_FLAGS + [
+            "--out-link", os.path.join(state_dir, "result"),
+            "{}#nixosConfigurations.{}.config.system.build.toplevel".format(
+                state_dir, hostname),
+        ]
+        script = "cd {} && {} && {} > build.log 2>&1; echo $? > status".format(
+            shlex.quote(state_dir), shlex.join(lock), shlex.join(build))
+        proc = subprocess.Popen(
+            ["sh", "-c", script],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+    except OSError as e:
+        libcalamares.utils.debug(
+            "Could not start speculative build: {}".format(e))
+        return None
+
+    return {
+        "dir": state_dir,
+        "pid": proc.pid,
+        "key": speculative_key(variables),
+    }
+
+
+def reconcile_speculative(speculative, variables):
+    """
+    Compare the speculative build against the real answers. If they
+    diverge, cancel the build (its process group) so it stops competing
+    for bandwidth; paths it already realised stay in the live store and
+    are still reused. Returns True if the speculation matched.
+    """
+    if speculative["key"] == speculative_key(variables):
+        libcalamares.utils.debug(
+            "Speculative build matches the chosen configuration")
+        return True
+
+    if _process_running(speculative["pid"]):
+        try:
+            os.killpg(speculative["pid"], signal.SIGTERM)
+        except OSError:
+            pass
+        libcalamares.utils.debug(
+            "Answers diverged from the speculative build; cancelled it")
+    return False
+
+
+# ─── Target store seeding ─────────────────────────────────────────
+# When the speculative build finished, most of the system's closure is
+# already in the live store. Rather than have nix copy it path by path
+# as a substituter, those paths are copied into the target store up
+# front, on a worker pool sized for the target disk, and registered
+# with --load-db. Identical files are written once and hardlinked, as
+# auto-optimise-store would do afterwards. Where source and target share
+# a btrfs or xfs filesystem (a headless install from a NixOS host), files
+# are reflinked instead of copied. The squashfs on the ISO can't be.
+# Seeding runs before anything else writes to the target store, and a
+# failure only means nix copies the rest itself.
+
+# ioctl(dest, FICLONE, src) from linux/fs.h
+FICLONE = 0x40049409
+
+# Concurrent path copies by the class of the disk holding /nix
+SEED_WORKERS = {"nvme": 16, "ssd": 8, "hdd": 2}
+SEED_WORKERS_DEFAULT = 4
+
+# Store files have their mtime set to 1 (the epoch plus one second)
+STORE_MTIME = 1
+
+
+def _file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class StoreCopier:
+    """Copies store paths into a target store, writing each file once."""
+
+    def __init__(self, root, source_root="/", cancelled=None):
+        self.root = root
+        self.source_root = source_root
+        self.cancelled = cancelled
+        self.reflink = True
+        self.stats = collections.Counter()
+        # (content hash, executable) -> first copy in the target store
+        self._copies = {}
+        self._lock = threading.Lock()
+
+    def _count(self, **counts):
+        with self._lock:
+            self.stats.update(counts)
+
+    def copy_path(self, path):
+        """Copy one store path (e.g. /nix/store/...-foo) into the target."""
+        if self.cancelled is not None and self.cancelled.is_set():
+            return
+        src = os.path.join(self.source_root, path.lstrip("/"))
+        dst = os.path.join(self.root, path.lstrip("/"))
+        # Left over from an earlier attempt, but never registered
+        if os.path.isdir(dst) and not os.path.islink(dst):
+            shutil.rmtree(dst)
+        elif os.path.lexists(dst):
+            os.remove(dst)
+        self._copy_entry(src, dst)
+        self._count(paths=1)
+
+    def _copy_entry(self, src, dst):
+        st = os.lstat(src)
+        if stat.S_ISLNK(st.st_mode):
+            os.symlink(os.readlink(src), dst)
+        elif stat.S_ISDIR(st.st_mode):
+            os.mkdir(dst, 0o755)
+            for name in os.listdir(src):
+                self._copy_entry(os.path.join(src, name),
+                                 os.path.join(dst, name))
+            os.chmod(dst, 0o555)
+        else:
+            self._copy_file(src, dst, st)
+            return
+        os.utime(dst, (STORE_MTIME, STORE_MTIME), follow_symlinks=False)
+
+    def _copy_file(self, src, dst, st):
+        executable = bool(st.st_mode & 0o111)
+        key = (_file_sha256(src), executable)
+        with self._lock:
+            first = self._copies.get(key)
+        if first:
+            try:
+                os.link(first, dst)
+                self._count(files=1, linkedBytes=st.st_size)
+                return
+            except OSError:
+                pass  # too many links, say; copy it instead
+
+        if self._reflink_file(src, dst):
+            self._count(files=1, reflinkedBytes=st.st_size)
+        else:
+            shutil.copyfile(src, dst)
+            self._count(files=1, copiedBytes=st.st_size)
+        os.chmod(dst, 0o555 if executable else 0o444)
+        os.utime(dst, (STORE_MTIME, STORE_MTIME))
+        with self._lock:
+            self._copies.setdefault(key, dst)
+
+    def _reflink_file(self, src, dst):
+        """Clone src into dst; False (and no more tries) if unsupported."""
+        if not self.reflink:
+            return False
+        with open(src, "rb") as s, open(dst, "wb") as d:
+            try:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+                return True
+            except OSError:
+                self.reflink = False
+                return False
+
+
+def seed_workers(storage):
+    """Copy workers for the disk class holding /nix (or /)."""
+    info = storage.get("/nix") or storage.get("/") or {}
+    return SEED_WORKERS.get(info.get("class"), SEED_WORKERS_DEFAULT)
+
+
+def speculative_closure(speculative, variables):
+    """
+    Live store paths of the finished speculative build, or [] when it
+    didn't finish or guessed a different home profile (whose closure
+    differs too much to be worth copying).
+    """
+    result = os.path.join(speculative["dir"], "result")
+    if not os.path.exists(result) or \
+            variables["homeprofile"] != SPECULATIVE_ANSWERS["cairn_homeProfile"]:
+        return []
+    try:
+        query = run_command(
+            "nix-store --query",
+            ["nix-store", "--query", "--requisites", result],
+            check=True, capture_output=True, text=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        libcalamares.utils.debug(
+            "Cannot list the speculative closure: {}".format(e))
+        return []
+    return query.stdout.split()
+
+
+def seed_target_store(paths, root, workers, source_root="/",
+                      cancelled=None):
+    """
+    Copy the store paths not yet valid in root's store from source_root
+    and register them there. Returns the copy statistics, with the
+    paths copied under "seeded".
+    """
+    invalid = run_command(
+        "nix-store --check-validity",
+        ["nix-store", "--store", root, "--check-validity", "--print-invalid"]
+        + paths,
+        check=True, capture_output=True, text=True).stdout.split()
+    copier = StoreCopier(root, source_root, cancelled)
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers,
+                            thread_name_prefix="cairn-seed") as pool:
+        list(pool.map(copier.copy_path, invalid))
+    if cancelled is not None and cancelled.is_set():
+        return dict(copier.stats, seeded=[])
+
+    if invalid:
+        registration = run_command(
+            "nix-store --dump-db", ["nix-store", "--dump-db"] + invalid,
+            check=True, capture_output=True).stdout
+        run_command(
+            "nix-store --load-db", ["nix-store", "--store", root, "--load-db"],
+            check=True, capture_output=True, input=registration)
+
+    stats = dict(copier.stats)
+    stats["seconds"] = round(time.monotonic() - start, 3)
+    stats["seeded"] = invalid
+    return stats
+
+
+def remove_unseeded(root, seeded, system_path):
+    """
+    Delete the seeded paths the installed system doesn't use. Returns
+    how many there were.
+    """
+    closure = run_command(
+        "nix-store --query",
+        ["nix-store", "--store", root, "--query", "--requisites",
+         system_path],
+        check=True, capture_output=True, text=True).stdout.split()
+    unused = sorted(set(seeded) - set(closure))
+    if unused:
+        run_command(
+            "nix-store --delete",
+            ["nix-store", "--store", root, "--delete"] + unused,
+            capture_output=True)
+    return len(unused)
+
+
+# ─── Prebuilt variants ────────────────────────────────────────────
+# The choices that decide most of the closure (form factor, CPU/GPU
+# vendor, profile, module toggles, unfree) have few combinations. The
+# "variants" command below builds the common ones ahead of time and
+# writes an index of their toplevels; ship it on the ISO and push the
+# toplevels to a binary cache (or keep them in the ISO's store).
+#
+# A prebuilt toplevel can't stand in for the real one, since hostname,
+# users and hardware.nix are part of it. Instead the install starts
+# realising the matching variant's closure in the background while nix
+# evaluates the real configuration, so nearly every path is already in
+# the target store by the time evaluation finishes, and only the
+# host-specific remainder is left to build.
+
+VARIANTS_INDEX = "/etc/cairn-installer/variants.json"
+VARIANTS_VERSION = 1
+
+# Template variables that pick a variant
+VARIANT_VARIABLES = ("formfactor", "cpu", "gpu", "homeprofile",
+                     "enable_gaming", "enable_pim", "enable_secrets",
+                     "enable_virt", "enable_libvirt", "enable_containers")
+
+
+def variant_choices(variables):
+    """The variant-deciding subset of a host's template variables."""
+    choices = {k: variables.get(k) for k in VARIANT_VARIABLES}
+    choices["unfree"] = "nixpkgs.config.allowUnfree = true;" in \
+        variables.get("extra_config", "")
+    return choices
+
+
+def variant_key(variables):
+    """Hash of variant_choices, the key in the variants index."""
+    return hashlib.sha256(json.dumps(
+        variant_choices(variables), sort_keys=True).encode()).hexdigest()
+
+
+def load_variants_index(path, pin=None):
+    """
+    Load the variants index, or None if there is none or it was built
+    from a different cairn revision than the one the install pins to.
+    """
+    try:
+        with open(path, "r") as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if index.get("version") != VARIANTS_VERSION:
+        return None
+    if pin and index.get("rev") and index["rev"] != pin["rev"]:
+        libcalamares.utils.debug(
+            "Ignoring variants index built from {}".format(index["rev"]))
+        return None
+    return index
+
+
+def start_variant_prefetch(cmd, log_path):
+    """
+    Start cmd, a nix build of a prebuilt toplevel into the target store,
+    in its own process group with stderr to log_path. Returns the Popen,
+    or None.
+    """
+    try:
+        with open(log_path, "w") as log:
+            return subprocess.Popen(
+                cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                stderr=log, start_new_session=True)
+    except OSError as e:
+        libcalamares.utils.debug(
+            "Could not start variant prefetch: {}".format(e))
+        return None
+
+
+def finish_variant_prefetch(proc):
+    """
+    Stop a variant prefetch once the real build is done; anything it is
+    still fetching isn't in the real closure. Returns its outcome.
+    """
+    if proc.poll() is None:
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)
+        except OSError:
+            pass
+        proc.wait()
+        return "cancelled"
+    return "complete" if proc.returncode == 0 else "failed"
+
+
+def build_variables(value):
+    """
+    Collect template variables from the installer answers.
+
+    value looks up an answer by globalstorage key and returns None when
+    it is unset, like libcalamares.globalstorage.value.
+    """
     variables = {}
 
-    catenate(variables, "hostname", gs.value("hostname"))
-    catenate(variables, "username", gs.value("username"))
-    catenate(variables, "fullname", gs.value("fullname"))
+    catenate(variables, "hostname", value("hostname"))
+    catenate(variables, "username", value("username"))
+    catenate(variables, "fullname", value("fullname"))
     catenate(variables, "timezone",
-             gs.value("locationRegion"), "/", gs.value("locationZone"))
+             value("locationRegion"), "/", value("locationZone"))
 
-    allow_unfree = gs.value("nixos_allow_unfree")
-    auto_login_user = gs.value("autoLoginUser")
+    allow_unfree = value("nixos_allow_unfree")
+    auto_login_user = value("autoLoginUser")
 
     # Keyboard
-    kb_layout = gs.value("keyboardLayout") or "us"
-    kb_variant = gs.value("keyboardVariant") or ""
+    kb_layout = value("keyboardLayout") or "us"
+    kb_variant = value("keyboardVariant") or ""
 
     # Firmware type
-    firmware_type = gs.value("firmwareType") or "efi"
+    firmware_type = value("firmwareType") or "efi"
 
     # ─── Cairn-specific config from QML page / auto-detection ─────
 
     # Form factor: default to desktop
-    form_factor = gs.value("cairn_formFactor") or "desktop"
+    form_factor = value("cairn_formFactor") or "desktop"
     variables["formfactor"] = form_factor
     variables["islaptop"] = nix_bool(form_factor == "laptop")
 
-    # Hardware: use detected values or null for MVP
-    cpu_vendor = gs.value("cairn_cpuVendor")
-    gpu_vendor = gs.value("cairn_gpuVendor")
+    # Detection details the page doesn't expose come from the profile
+    profile = value("cairn_hardwareProfile") or {}
+    profile_cpu = profile.get("cpu") or {}
+
+    # Hardware: use the page's values, else detected ones, else null
+    cpu_vendor = value("cairn_cpuVendor") or profile_cpu.get("vendor")
+    gpu_vendor = (value("cairn_gpuVendor")
+                  or (profile.get("gpu") or {}).get("vendor"))
     variables["cpu"] = nix_string_or_null(cpu_vendor)
     variables["gpu"] = nix_string_or_null(gpu_vendor)
-    variables["hasssd"] = nix_bool(gs.value("cairn_hasSSD") or False)
+    # The disks actually installed to decide hasSSD when known
+    storage = value("cairn_targetStorage") or {}
+    if "/" in storage:
+        variables["hasssd"] = nix_bool(storage["/"]["class"] != "hdd")
+    else:
+        variables["hasssd"] = nix_bool(value("cairn_hasSSD") or False)
+
+    cpu_level = value("cairn_cpuLevel") or profile_cpu.get("x86_64Level") or ""
+    cpufreq_driver = (value("cairn_cpufreqDriver")
+                      or profile_cpu.get("cpufreqDriver") or "")
 
     # Profile
-    home_profile = gs.value("cairn_homeProfile") or "standard"
+    home_profile = value("cairn_homeProfile") or "standard"
     variables["homeprofile"] = home_profile
 
     # Feature toggles
@@ -299,11 +2275,11 @@ def run():
         enable_libvirt = False
         enable_containers = False
     else:
-        enable_gaming = gs.value("cairn_enableGaming") or False
-        enable_pim = gs.value("cairn_enablePim") or False
-        enable_secrets = gs.value("cairn_enableSecrets") or False
-        enable_libvirt = gs.value("cairn_enableLibvirt") or False
-        enable_containers = gs.value("cairn_enableContainers") or False
+        enable_gaming = value("cairn_enableGaming") or False
+        enable_pim = value("cairn_enablePim") or False
+        enable_secrets = value("cairn_enableSecrets") or False
+        enable_libvirt = value("cairn_enableLibvirt") or False
+        enable_containers = value("cairn_enableContainers") or False
     enable_virt = enable_libvirt or enable_containers
 
     variables["enable_gaming"] = nix_bool(enable_gaming)
@@ -315,6 +2291,9 @@ def run():
 
     # ─── Build extra config lines ───────────────────────────────
     extra_lines = []
+    # Collected from several sections, emitted once (a Nix attrset can't
+    # define the same attribute twice)
+    kernel_params = []
 
     # Keyboard layout in extraConfig
     if kb_layout:
@@ -331,7 +2310,7 @@ def run():
 
     # PIM role
     if enable_pim:
-        pim_role = gs.value("cairn_pimRole") or "server"
+        pim_role = value("cairn_pimRole") or "server"
         extra_lines.append("")
         extra_lines.append(
             '      services.pim.role = "{}";'.format(pim_role))
@@ -341,18 +2320,18 @@ def run():
                     variables.get("username", "")))
 
     # Immich
-    enable_immich = gs.value("cairn_enableImmich") or False
+    enable_immich = value("cairn_enableImmich") or False
     if enable_immich:
-        immich_role = gs.value("cairn_immichRole") or "client"
+        immich_role = value("cairn_immichRole") or "client"
         extra_lines.append("")
         extra_lines.append("      cairn.immich.enable = true;")
         extra_lines.append(
             '      cairn.immich.role = "{}";'.format(immich_role))
 
     # Local LLM
-    enable_local_llm = gs.value("cairn_enableLocalLlm") or False
+    enable_local_llm = value("cairn_enableLocalLlm") or False
     if enable_local_llm:
-        llm_role = gs.value("cairn_localLlmRole") or "server"
+        llm_role = value("cairn_localLlmRole") or "server"
         extra_lines.append("")
         extra_lines.append("      services.ai.local.enable = true;")
         extra_lines.append(
@@ -360,9 +2339,9 @@ def run():
 
     # Tailnet domain — notesqml doesn't support keyboard input, so we
     # write a placeholder that the user must update post-install.
-    pim_role = gs.value("cairn_pimRole") or "server"
-    immich_role = gs.value("cairn_immichRole") or "server"
-    llm_role = gs.value("cairn_localLlmRole") or "server"
+    pim_role = value("cairn_pimRole") or "server"
+    immich_role = value("cairn_immichRole") or "server"
+    llm_role = value("cairn_localLlmRole") or "server"
     needs_tailnet = (
         (enable_pim and pim_role == "client")
         or (enable_immich and immich_role == "client")
@@ -382,14 +2361,534 @@ def run():
                 '      services.ai.local.tailnetDomain = "CHANGE-ME.ts.net";')
 
     # Secure boot
-    enable_secureboot = gs.value("cairn_enableSecureBoot") or False
+    enable_secureboot = value("cairn_enableSecureBoot") or False
     if enable_secureboot:
         extra_lines.append("")
         extra_lines.append(
             "      boot.lanzaboote.enableSecureBoot = true;")
 
+    # CPU tuning from cairndetect
+    if cpu_level or cpufreq_driver:
+        extra_lines.append("")
+        extra_lines.append("      # CPU tuning (detected: x86-64-{}, {})".format(
+            cpu_level or "unknown", cpufreq_driver or "no cpufreq driver"))
+    if cpu_level:
+        extra_lines.append(
+            "      nix.settings.system-features = {};".format(
+                nix_list(cpu_system_features(cpu_level))))
+    if cpufreq_driver.startswith("amd-pstate"):
+        # Active (EPP) mode; the powersave governor lets firmware pick
+        # frequencies from the energy-performance preference
+        kernel_params.append("amd_pstate=active")
+    elif cpufreq_driver == "intel_pstate":
+        extra_lines.append("      services.thermald.enable = true;")
+    elif cpufreq_driver == "acpi-cpufreq":
+        extra_lines.append(
+            '      hardware.{}.cpuGovernor = "schedutil";'.format(form_factor))
+
+    # Hybrid graphics, unless the page changed the GPU away from NVIDIA
+    prime = (profile.get("gpu") or {}).get("prime")
+    if prime and gpu_vendor == "nvidia":
+        extra_lines.append("")
+        extra_lines.append("      # Hybrid graphics: display on the iGPU, "
+                           "NVIDIA via nvidia-offload")
+        extra_lines.append("      cairn.hardware.prime = {")
+        extra_lines.append("        enable = true;")
+        for key in sorted(prime):
+            extra_lines.append('        {} = "{}";'.format(key, prime[key]))
+        extra_lines.append("      };")
+
+    total_memory = (profile.get("memory") or {}).get("totalBytes")
+    if total_memory:
+        extra_lines.extend(memory_config_lines(
+            total_memory,
+            value("cairn_cpuThreads") or profile_cpu.get("threads")))
+
+    # I/O schedulers for the kinds of disk the system is installed on
+    storage_classes = {info["class"] for info in storage.values()}
+    rules = [IO_SCHEDULER_RULES[c] for c in reversed(STORAGE_CLASSES)
+             if c in storage_classes]
+    if rules:
+        extra_lines.append("")
+        extra_lines.append("      services.udev.extraRules = {};".format(
+            nix_string("\n".join(rules) + "\n")))
+
+    if kernel_params:
+        extra_lines.append("")
+        extra_lines.append(
+            "      boot.kernelParams = {};".format(nix_list(kernel_params)))
+
     variables["extra_config"] = "\n".join(extra_lines)
 
+    return variables
+
+
+# ─── Install plan ─────────────────────────────────────────────────
+# An exec step between the configuration page and partitioning (the
+# "plan" instance of this module, mode: plan) dry-runs the chosen
+# configuration against the live store: how many paths nix would fetch
+# and build, how much it downloads and unpacks, and roughly how long
+# that takes at the throughput measured from the binary caches. The plan
+# page shows the result, with what leaving out the optional features
+# would save, and install() keeps it in the install metrics.
+
+PLAN_DIR = "/run/cairn-installer/plan"
+PLAN_TIMEOUT = 300
+
+# nix build --dry-run headings (on stderr); the paths follow, indented
+DRY_RUN_BUILD_RE = re.compile(
+    r"^(?:these \d+ derivations|this derivation) will be built:")
+DRY_RUN_FETCH_RE = re.compile(
+    r"^(?:these \d+ paths|this path) will be fetched"
+    r"(?: \((?P<download>[\d.]+) (?P<download_unit>\w+) download, "
+    r"(?P<unpacked>[\d.]+) (?P<unpacked_unit>\w+) unpacked\))?:")
+SIZE_UNITS = {"B": 1, "KiB": 2**10, "MiB": 2**20, "GiB": 2**30, "TiB": 2**40}
+
+# The dry run can't tell how long a build takes; a rough average per
+# derivation (most are small wrappers, a few are whole applications)
+BUILD_SECONDS = 60
+
+# Feature toggles the plan page offers to leave out. Secure Boot stays:
+# it is a security choice, and lanzaboote is small.
+OPTIONAL_FEATURES = (
+    "cairn_enableGaming",
+    "cairn_enablePim",
+    "cairn_enableSecrets",
+    "cairn_enableImmich",
+    "cairn_enableLibvirt",
+    "cairn_enableLocalLlm",
+    "cairn_enableContainers",
+)
+
+
+def parse_dry_run(text):
+    """
+    Count the paths nix build --dry-run would build and fetch, and the
+    download and unpacked sizes of the fetched ones.
+    """
+    plan = {"build": 0, "fetch": 0, "downloadBytes": 0, "unpackedBytes": 0}
+    section = None
+    for line in text.splitlines():
+        if section and line.startswith(" ") and line.strip():
+            plan[section] += 1
+            continue
+        section = None
+        if DRY_RUN_BUILD_RE.match(line):
+            section = "build"
+            continue
+        match = DRY_RUN_FETCH_RE.match(line)
+        if match:
+            section = "fetch"
+            for key in ("download", "unpacked"):
+                if match.group(key):
+                    plan[key + "Bytes"] += int(
+                        float(match.group(key))
+                        * SIZE_UNITS.get(match.group(key + "_unit"), 1))
+    return plan
+
+
+def estimate_seconds(plan, throughput):
+    """
+    Rough install duration for a parsed dry run at throughput bytes/s,
+    or None if it has to download and no throughput was measured.
+    """
+    seconds = plan["build"] * BUILD_SECONDS
+    if plan["downloadBytes"]:
+        if not throughput:
+            return None
+        seconds += plan["downloadBytes"] / throughput
+    return round(seconds)
+
+
+def format_bytes(size):
+    """1536 -> "1.5 KiB"."""
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024 or unit == "GiB":
+            break
+        size /= 1024
+    return "{:.0f} {}".format(size, unit) if unit == "B" else \
+        "{:.1f} {}".format(size, unit)
+
+
+def format_duration(seconds):
+    """Minutes, or "under a minute"; None -> "unknown"."""
+    if seconds is None:
+        return "unknown"
+    if seconds < 60:
+        return "under a minute"
+    minutes = round(seconds / 60)
+    if minutes < 60:
+        return "about {} min".format(minutes)
+    return "about {}h {:02d}min".format(minutes // 60, minutes % 60)
+
+
+def describe_plan(plan):
+    """One line for a parsed dry run (with its etaSeconds)."""
+    return "{} paths to download ({}, {} unpacked), {} to build, {}".format(
+        plan["fetch"], format_bytes(plan["downloadBytes"]),
+        format_bytes(plan["unpackedBytes"]), plan["build"],
+        format_duration(plan["etaSeconds"]))
+
+
+def plan_throughput(substituters, probes):
+    """Measured throughput of the fastest-ranked cache, else of any."""
+    by_url = {p["url"]: p for p in probes}
+    for url in substituters:
+        if (by_url.get(url) or {}).get("throughput"):
+            return by_url[url]["throughput"]
+    return max([p["throughput"] for p in probes if p["throughput"]] or [0]) \
+        or None
+
+
+def dry_run_plan(flake_dir, hostname, nix_options):
+    """Dry-run the host's toplevel against the live store and parse it."""
+    ref = "{}#nixosConfigurations.{}.config.system.build.toplevel".format(
+        flake_dir, hostname)
+    result = run_command(
+        "nix build --dry-run",
+        generate_proxy_strings() + ["nix", "build"] + NIX_FLAGS
+        + ["--dry-run", ref] + nix_options,
+        check=True, capture_output=True, text=True, timeout=PLAN_TIMEOUT)
+    return parse_dry_run(result.stderr)
+
+
+def plan_install(gs, job_config, state_dir=PLAN_DIR):
+    """
+    Work out what installing the chosen configuration will fetch and
+    build, and what it would without the optional features. The target
+    disks aren't known yet, so the speculative hardware configuration
+    stands in for the real one. Returns the plan for cairn_installPlan;
+    raises OSError or subprocess errors if nix can't produce one.
+    """
+    def chosen(key):
+        answer = gs.value(key)
+        if answer is None:
+            return SPECULATIVE_ANSWERS.get(key)
+        return answer
+
+    selected = build_variables(chosen)
+    optional = []
+    if selected["homeprofile"] != "normie":
+        optional = [key for key in OPTIONAL_FEATURES if gs.value(key)]
+    flakes = {"selected": selected}
+    if optional:
+        flakes["minimal"] = build_variables(
+            lambda key: False if key in OPTIONAL_FEATURES else chosen(key))
+
+    pin = load_source_pin(job_config.get("sourcePin") or DEFAULT_SOURCE_PIN)
+    install_mode, use_pin = resolve_install_mode(
+        job_config.get("installMode") or "auto", pin)
+    substituters, probing = start_probing(job_config, install_mode)
+
+    shutil.rmtree(state_dir, ignore_errors=True)
+    for name, variables in flakes.items():
+        host_hw_dir = write_flake(os.path.join(state_dir, name), variables)
+        with open(os.path.join(host_hw_dir, "hardware.nix"), "w") as f:
+            f.write(speculative_hardware)
+    libcalamares.job.setprogress(0.1)
+
+    # Every variant has the same flake.nix, so one lock serves them all
+    prefetch = gs.value("cairn_prefetch")
+    if prefetch:
+        wait_for_prefetch(prefetch, report=lambda fraction:
+                          libcalamares.job.setprogress(0.1 + 0.2 * fraction))
+    selected_dir = os.path.join(state_dir, "selected")
+    run_command(
+        "nix flake lock",
+        flake_lock_command(install_mode, pin if use_pin else None),
+        cwd=selected_dir, check=True, capture_output=True, text=True,
+        timeout=PLAN_TIMEOUT)
+    for name in flakes:
+        if name != "selected":
+            shutil.copy(os.path.join(selected_dir, "flake.lock"),
+                        os.path.join(state_dir, name, "flake.lock"))
+    libcalamares.job.setprogress(0.4)
+
+    throughput = None
+    if probing:
+        substituters, probes = finish_probing(substituters, probing)
+        throughput = plan_throughput(substituters, probes)
+    nix_options = job_substituter_options(job_config, install_mode,
+                                          substituters)
+
+    with ThreadPoolExecutor(max_workers=len(flakes)) as pool:
+        futures = {
+            name: pool.submit(dry_run_plan, os.path.join(state_dir, name),
+                              selected["hostname"], nix_options)
+            for name in flakes
+        }
+        dry_runs = {name: future.result() for name, future in futures.items()}
+
+    plan = {
+        "installMode": install_mode,
+        "throughputBytes": round(throughput) if throughput else None,
+        "optionalFeatures": optional,
+    }
+    for name, dry_run in dry_runs.items():
+        dry_run["etaSeconds"] = estimate_seconds(dry_run, throughput)
+        dry_run["text"] = describe_plan(dry_run)
+        plan[name] = dry_run
+
+    minimal = plan.get("minimal")
+    if minimal:
+        saved = plan["selected"]["downloadBytes"] - minimal["downloadBytes"]
+        eta, minimal_eta = plan["selected"]["etaSeconds"], minimal["etaSeconds"]
+        plan["savingsText"] = "{} less to download{}".format(
+            format_bytes(max(saved, 0)),
+            ", {} sooner".format(format_duration(eta - minimal_eta))
+            if eta is not None and minimal_eta is not None
+            and eta - minimal_eta >= 60 else "")
+    return plan
+
+
+def run_plan(gs):
+    """
+    Job entry point for mode: plan. Records cairn_installPlan; a plan
+    that can't be made is recorded as an error and never stops the
+    installer.
+    """
+    job_config = libcalamares.job.configuration or {}
+    try:
+        result = plan_install(gs, job_config)
+    except subprocess.TimeoutExpired:
+        result = {"error": "nix timed out after {}s".format(PLAN_TIMEOUT)}
+    except subprocess.CalledProcessError as e:
+        result = {"error": "{} failed: {}".format(
+            shlex.join(e.cmd[:3]), (e.stderr or "").strip()[-2000:])}
+    except OSError as e:
+        result = {"error": str(e)}
+
+    if "error" in result:
+        libcalamares.utils.debug(
+            "No install plan: {}".format(result["error"]))
+    else:
+        libcalamares.utils.debug("Install plan: " + result["selected"]["text"])
+        if "minimal" in result:
+            libcalamares.utils.debug(
+                "Without optional features: " + result["minimal"]["text"])
+    gs.insert("cairn_installPlan", result)
+    libcalamares.job.setprogress(1.0)
+    return None
+
+
+# ─── Install checkpoint ───────────────────────────────────────────
+# Each phase that completes is recorded on the target with a hash of
+# its inputs and of the files it left behind. Rerunning the job after a
+# late failure (a network drop during the build, say) skips every phase
+# whose inputs and files are unchanged, as long as the phases it builds
+# on were skipped too. The build itself
+# always reruns unless it finished, but paths already copied into the
+# target store stay valid, so nix only fetches what is still missing.
+
+CHECKPOINT = "var/lib/cairn-install/checkpoint.json"
+CHECKPOINT_VERSION = 1
+
+
+def input_digest(inputs):
+    """sha256 of a JSON-serialisable description of a phase's inputs."""
+    encoded = json.dumps(inputs, sort_keys=True, default=str)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+def file_digest(path):
+    """sha256 of a file's contents, or None if it can't be read."""
+    try:
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+
+class Checkpoint:
+    """Completed install phases, kept in <root>/CHECKPOINT between attempts."""
+
+    def __init__(self, root, enabled=True):
+        self.root = root
+        self.path = os.path.join(root, CHECKPOINT)
+        self.phases = {}
+        self.skipped = []
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        if not enabled:
+            return
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            if data.get("version") == CHECKPOINT_VERSION:
+                self.phases = data.get("phases") or {}
+        except (OSError, ValueError, AttributeError):
+            pass
+
+    def resume(self, name, inputs, valid=None, after=()):
+        """
+        Return the outputs recorded for phase name if it completed with
+        the same inputs, its files are unchanged, every phase in after was
+        resumed as well and valid(outputs) (when given) holds; otherwise
+        None, and the phase has to run.
+        """
+        entry = self.phases.get(name)
+        if not self.enabled or not entry \
+                or any(phase not in self.skipped for phase in after) \
+                or entry.get("inputs") != input_digest(inputs) \
+                or any(file_digest(os.path.join(self.root, rel)) != digest
+                       for rel, digest in entry.get("files", {}).items()) \
+                or (valid is not None and not valid(entry.get("outputs") or {})):
+            return None
+        self.skipped.append(name)
+        libcalamares.utils.debug(
+            "Resuming: {} is unchanged since the last attempt".format(name))
+        return entry.get("outputs") or {}
+
+    def complete(self, name, inputs, outputs=None, files=()):
+        """Record phase name as done and save the checkpoint."""
+        entry = {
+            "inputs": input_digest(inputs),
+            "outputs": outputs or {},
+            "files": {os.path.relpath(path, self.root): file_digest(path)
+                      for path in files},
+            "completedAt": datetime.now(timezone.utc).isoformat(),
+        }
+        try:
+            with self._lock:
+                self.phases[name] = entry
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                write_atomic(self.path, json.dumps({
+                    "version": CHECKPOINT_VERSION,
+                    "phases": self.phases,
+                }, indent=2, sort_keys=True) + "\n")
+        except OSError as e:
+            libcalamares.utils.debug(
+                "Cannot write {}: {}".format(self.path, e))
+
+    def clear(self):
+        """Remove the checkpoint once the install has succeeded."""
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+# ─── Phase scheduling ─────────────────────────────────────────────
+# install() declares its phases as tasks, each naming the tasks whose
+# outputs it reads. A task starts on its own thread as soon as those
+# have finished: the flake locks while nixos-generate-config runs and
+# hardware.nix is rewritten, and meanwhile the target store is seeded
+# from the live one and the prebuilt variant's closure downloads. Job
+# progress is the weighted sum of the tasks'; the first failure stops
+# everything else.
+
+Task = collections.namedtuple("Task", ["name", "needs", "weight", "func"])
+
+
+class InstallError(Exception):
+    """A failed task; args are the (title, description) the job returns."""
+
+
+class TaskRun:
+    """Handed to a task: earlier outputs, a progress setter, cancellation."""
+
+    def __init__(self, outputs, cancelled):
+        self.outputs = outputs
+        self.cancelled = cancelled
+        self.fraction = 0.0
+
+    def progress(self, fraction):
+        self.fraction = min(max(fraction, 0.0), 1.0)
+
+
+def _run_task(task, run):
+    with METRICS.task(task.name):
+        return task.func(run)
+
+
+def run_tasks(tasks, report=None, interval=PROGRESS_INTERVAL):
+    """
+    Run each task once every task named in its needs has finished.
+    task.func gets a TaskRun and returns the task's output, or raises
+    InstallError. report(fraction), if given, is called from this thread
+    with the weighted progress of all tasks.
+
+    Returns (outputs by task name, error): error is None, or the (title,
+    description) of the first task that failed. After a failure no more
+    tasks start, the commands still running are terminated, and the
+    tasks still running are waited for.
+    """
+    names = {task.name for task in tasks}
+    for task in tasks:
+        unknown = set(task.needs) - names
+        if unknown:
+            raise ValueError("Task {} needs unknown tasks: {}".format(
+                task.name, ", ".join(sorted(unknown))))
+    total = sum(task.weight for task in tasks) or 1
+
+    cancelled = threading.Event()
+    pending = list(tasks)
+    runs = {}
+    running = {}
+    outputs = {}
+    error = None
+    with ThreadPoolExecutor(max_workers=max(len(tasks), 1),
+                            thread_name_prefix="cairn") as pool:
+        while True:
+            if error is None:
+                for task in [t for t in pending
+                             if all(n in outputs for n in t.needs)]:
+                    pending.remove(task)
+                    runs[task.name] = TaskRun(dict(outputs), cancelled)
+                    running[pool.submit(_run_task, task, runs[task.name])] = task
+            if not running:
+                break
+
+            done, _ = wait(running, timeout=interval,
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                task = running.pop(future)
+                try:
+                    output = future.result()
+                except InstallError as e:
+                    failure = tuple(e.args)
+                except Exception as e:
+                    failure = ("Install failed",
+                               "{} failed: {}".format(task.name, e))
+                else:
+                    outputs[task.name] = output
+                    runs[task.name].fraction = 1.0
+                    continue
+                if error is None:
+                    error = failure
+                    libcalamares.utils.debug(
+                        "{} failed; stopping the other phases".format(
+                            task.name))
+                    cancelled.set()
+                    terminate_commands()
+
+            if report:
+                report(sum(runs[task.name].fraction * task.weight
+                           for task in tasks if task.name in runs) / total)
+
+    if pending and error is None:
+        raise ValueError("Tasks wait on each other: {}".format(
+            ", ".join(task.name for task in pending)))
+    return outputs, error
+
+
+def install(gs, root_mount_point):
+    """
+    Generate the flake and install it to root_mount_point.
+    Returns None on success or a (title, description) error tuple.
+    """
+    METRICS.phase("collect")
+
+    # ─── Read globalstorage ─────────────────────────────────────
+    storage = target_storage(root_mount_point)
+    if storage:
+        gs.insert("cairn_targetStorage", storage)
+        libcalamares.utils.debug("Target storage: {}".format(", ".join(
+            "{} on {} ({})".format(m, "+".join(i["disks"]), i["class"])
+            for m, i in storage.items())))
+    variables = build_variables(gs.value)
+    allow_unfree = gs.value("nixos_allow_unfree")
+
     # ─── Validate required variables ────────────────────────────
     if "hostname" not in variables:
         return ("Missing hostname",
@@ -401,137 +2900,766 @@ def run():
         return ("Missing timezone",
                 "No timezone was set in the installer")
 
-    libcalamares.job.setprogress(0.1)
+    speculative = gs.value("cairn_speculative")
+    if speculative:
+        reconcile_speculative(speculative, variables)
+
+    # What the plan step predicted, to compare with what the build did
+    install_plan = gs.value("cairn_installPlan")
+    if install_plan:
+        METRICS.extra["installPlan"] = dict(
+            install_plan, minimalChosen=bool(gs.value("cairn_planMinimal")))
 
-    # ─── Generate config files ──────────────────────────────────
     hostname = variables["hostname"]
     nixos_dir = os.path.join(root_mount_point, "etc/nixos")
-    hosts_dir = os.path.join(nixos_dir, "hosts")
-    host_hw_dir = os.path.join(hosts_dir, hostname)
-    users_dir = os.path.join(nixos_dir, "users")
+    host_hw_dir = os.path.join(nixos_dir, "hosts", hostname)
+    hw_dest = os.path.join(host_hw_dir, "hardware.nix")
+    job_config = libcalamares.job.configuration or {}
+    checkpoint = Checkpoint(root_mount_point, job_config.get("resume", True))
+    METRICS.extra["resumedPhases"] = checkpoint.skipped
+    profile = gs.value("cairn_hardwareProfile")
+    pin = load_source_pin(job_config.get("sourcePin") or DEFAULT_SOURCE_PIN)
 
-    os.makedirs(host_hw_dir, exist_ok=True)
-    os.makedirs(users_dir, exist_ok=True)
+    libcalamares.job.setprogress(0.1)
 
-    # Apply variable substitution to templates
-    def substitute(template):
-        result = template
-        for key, value in variables.items():
-            pattern = "@@{}@@".format(key)
-            result = result.replace(pattern, str(value))
-        return result
+    # ─── Generate config files ──────────────────────────────────
+    def generate(run):
+        generate_inputs = [variables, profile, cfg_flake, cfg_host, cfg_user]
+        if checkpoint.resume("generate", generate_inputs) is not None:
+            return None
+
+        unresolved = set()
+        write_flake(nixos_dir, variables, unresolved)
+        if unresolved:
+            raise InstallError(
+                "Incomplete configuration",
+                "No value for: {}".format(", ".join(sorted(unresolved))))
+
+        if profile:
+            write_hardware_profile(host_hw_dir, profile)
+
+        checkpoint.complete("generate", generate_inputs, files=[
+            os.path.join(nixos_dir, "flake.nix"),
+            os.path.join(nixos_dir, "hosts", "{}.nix".format(hostname)),
+            os.path.join(nixos_dir, "users",
+                         "{}.nix".format(variables["username"])),
+        ])
+        return None
 
-    # Write flake.nix
-    with open(os.path.join(nixos_dir, "flake.nix"), "w") as f:
-        f.write(substitute(cfg_flake))
+    # ─── Generate hardware-configuration.nix ────────────────────
+    def hardware_config(run):
+        # nixos-generate-config only looks at what is mounted on the target
+        prefix = root_mount_point.rstrip("/") + "/"
+        hardware_inputs = sorted(
+            (mount, info["fsType"], info["source"])
+            for mount, info in parse_mountinfo().items()
+            if mount == root_mount_point or mount.startswith(prefix))
+        generated = checkpoint.resume("hardware-config", hardware_inputs)
+        if generated is not None:
+            return generated
 
-    # Write host config
-    with open(os.path.join(hosts_dir, "{}.nix".format(hostname)), "w") as f:
-        f.write(substitute(cfg_host))
+        try:
+            run_command(
+                "nixos-generate-config",
+                ["nixos-generate-config", "--root", root_mount_point],
+                check=True, capture_output=True, text=True
+            )
+        except subprocess.CalledProcessError as e:
+            raise InstallError(
+                "Failed to generate hardware config",
+                "nixos-generate-config failed: {}".format(e.stderr))
 
-    # Write user config
-    with open(os.path.join(users_dir, "{}.nix".format(variables["username"])), "w") as f:
-        f.write(substitute(cfg_user))
+        # Move hardware-configuration.nix to hosts/<hostname>/hardware.nix
+        # (generate may not have created the host directory yet)
+        os.makedirs(host_hw_dir, exist_ok=True)
+        hw_source = os.path.join(root_mount_point, "etc/nixos/hardware-configuration.nix")
+        if os.path.exists(hw_source):
+            shutil.move(hw_source, hw_dest)
 
-    libcalamares.job.setprogress(0.18)
+        # Remove the generated configuration.nix (we don't need it)
+        gen_config = os.path.join(root_mount_point, "etc/nixos/configuration.nix")
+        if os.path.exists(gen_config):
+            os.remove(gen_config)
 
-    # ─── Generate hardware-configuration.nix ────────────────────
+        # Keep the unrewritten file so a retry can redo just the rewrite
+        try:
+            with open(hw_dest, "r") as f:
+                generated = {"hardwareConfig": f.read()}
+        except OSError:
+            generated = {"hardwareConfig": None}
+        checkpoint.complete("hardware-config", hardware_inputs, generated)
+        return generated
+
+    # Fix btrfs subvolumes, strip unfree kernel packages, ...
+    def hardware_rewrite(run):
+        generated = run.outputs["hardware-config"]
+        rewrite_context = {
+            "allowUnfree": allow_unfree,
+            "unfreeCache": job_config.get("unfreeCache"),
+            "storage": storage,
+        }
+        rewrite_inputs = [generated.get("hardwareConfig"), rewrite_context]
+        if checkpoint.resume("hardware-rewrite", rewrite_inputs,
+                             after=["hardware-config"]) is None:
+            if generated.get("hardwareConfig") is not None:
+                write_atomic(hw_dest, generated["hardwareConfig"])
+            rewrite_hardware_config(hw_dest, rewrite_context)
+            checkpoint.complete(
+                "hardware-rewrite", rewrite_inputs,
+                files=[hw_dest] if os.path.exists(hw_dest) else [])
+
+        nodatacow = apply_nodatacow(
+            root_mount_point, variables["enable_libvirt"] == "true")
+        if nodatacow:
+            libcalamares.utils.debug(
+                "Copy-on-write disabled for {}".format(", ".join(nodatacow)))
+        return None
+
+    # ─── Pick the install mode ─────────────────────────────────
+    def resolve_mode(run):
+        # Pinning cairn to the ISO's revision lets nix reuse its source
+        # from the live store
+        install_mode, use_pin = resolve_install_mode(
+            job_config.get("installMode") or "auto", pin)
+        libcalamares.utils.debug(
+            "Install mode: {}{}".format(
+                install_mode,
+                ", cairn pinned to ISO revision {}".format(pin["rev"])
+                if use_pin else ""))
+        gs.insert("cairn_installMode", install_mode)
+        METRICS.extra["installMode"] = install_mode
+        return {"mode": install_mode, "pin": pin if use_pin else None}
+
+    # ─── Lock the flake ────────────────────────────────────────
+    def lock_flake(run):
+        # nixos-install --flake will resolve inputs, but we lock first
+        # to get a clear error if the inputs can't be fetched.
+        install_mode = run.outputs["install-mode"]["mode"]
+        lock_pin = run.outputs["install-mode"]["pin"]
+        lock_inputs = [file_digest(os.path.join(nixos_dir, "flake.nix")),
+                       install_mode, lock_pin]
+        if checkpoint.resume("flake-lock", lock_inputs,
+                             after=["generate"]) is not None:
+            return None
+
+        # Reuse the prefetch cairndetect started during the show phase; the
+        # lock below then finds every input already in the live store.
+        prefetch = gs.value("cairn_prefetch")
+        if prefetch:
+            wait_for_prefetch(prefetch, report=lambda f: run.progress(0.8 * f),
+                              cancelled=run.cancelled)
+
+        # Lock a copy of flake.nix on its own: nix copies the flake's
+        # directory while nixos-generate-config is still writing to it
+        libcalamares.utils.debug("Locking flake inputs...")
+        lock_dir = tempfile.mkdtemp(prefix="cairn-lock-")
+        try:
+            shutil.copy(os.path.join(nixos_dir, "flake.nix"), lock_dir)
+            run_command(
+                "nix flake lock",
+                flake_lock_command(install_mode, lock_pin),
+                cwd=lock_dir,
+                check=True, capture_output=True, text=True,
+                timeout=300
+            )
+            shutil.copy(os.path.join(lock_dir, "flake.lock"), nixos_dir)
+        except subprocess.TimeoutExpired:
+            raise InstallError(
+                "Flake lock timed out",
+                "nix flake lock timed out after 5 minutes. "
+                "Check your network connection.")
+        except subprocess.CalledProcessError as e:
+            if install_mode == "offline":
+                raise InstallError(
+                    "Failed to lock flake",
+                    "nix flake lock failed in offline mode; the live medium "
+                    "does not contain all flake inputs:\n{}".format(e.stderr))
+            raise InstallError(
+                "Failed to lock flake",
+                "nix flake lock failed (is the network available?):\n{}".format(
+                    e.stderr))
+        finally:
+            shutil.rmtree(lock_dir, ignore_errors=True)
+
+        checkpoint.complete("flake-lock", lock_inputs,
+                            files=[os.path.join(nixos_dir, "flake.lock")])
+        return None
+
+    # ─── Build options ─────────────────────────────────────────
+    def build_options(run):
+        install_mode = run.outputs["install-mode"]["mode"]
+        # Probe the network caches while the flake locks
+        substituters, probing = start_probing(job_config, install_mode)
+        tuning = build_tuning(
+            gs.value("cairn_cpuThreads")
+            or ((profile or {}).get("cpu") or {}).get("threads"),
+            read_meminfo().get("MemAvailable", 0),
+            free_space(root_mount_point),
+            root_mount_point,
+        )
+        if tuning["build-dir"] != LIVE_BUILD_DIR:
+            os.makedirs(tuning["build-dir"], exist_ok=True)
+        METRICS.extra["buildTuning"] = tuning
+        libcalamares.utils.debug(
+            "Build tuning: max-jobs={} cores={} max-substitution-jobs={} "
+            "http-connections={} ({})".format(
+                tuning["max-jobs"], tuning["cores"],
+                tuning["max-substitution-jobs"], tuning["http-connections"],
+                tuning["reason"]))
+        if probing:
+            substituters, probes = finish_probing(substituters, probing)
+            METRICS.extra["substituterProbes"] = probes
+        # Share identical files as they land, like the installed system
+        # does (auto-optimise-store in modules/system/nix.nix)
+        return tuning_options(tuning) + [
+            "--option", "auto-optimise-store", "true",
+        ] + job_substituter_options(job_config, install_mode, substituters)
+
+    # Copy what the speculative build realised into the target store
+    def store_seed(run):
+        paths = speculative_closure(speculative, variables) \
+            if speculative else []
+        if not paths:
+            return []
+        try:
+            stats = seed_target_store(paths, root_mount_point,
+                                      seed_workers(storage),
+                                      cancelled=run.cancelled)
+        except (OSError, subprocess.CalledProcessError) as e:
+            libcalamares.utils.debug(
+                "Seeding the target store failed; nix copies the rest: "
+                "{}".format(e))
+            return []
+        seeded = stats.pop("seeded")
+        METRICS.extra["storeSeed"] = stats
+        libcalamares.utils.debug(
+            "Seeded {} store paths: {:.1f} MiB copied, {:.1f} MiB reflinked, "
+            "{:.1f} MiB hardlinked".format(
+                len(seeded), stats.get("copiedBytes", 0) / 2**20,
+                stats.get("reflinkedBytes", 0) / 2**20,
+                stats.get("linkedBytes", 0) / 2**20))
+        return seeded
+
+    # Realise the matching prebuilt variant while the rest runs
+    def variant_prefetch(run):
+        index = load_variants_index(
+            job_config.get("variantsIndex") or VARIANTS_INDEX,
+            run.outputs["install-mode"]["pin"])
+        variant = (index or {}).get("variants", {}).get(variant_key(variables))
+        if not variant:
+            if index:
+                libcalamares.utils.debug("No prebuilt variant for these choices")
+            return None
+        libcalamares.utils.debug(
+            "Prefetching prebuilt variant {}".format(variant["toplevel"]))
+        METRICS.extra["variant"] = {"toplevel": variant["toplevel"]}
+        log_dir = os.path.join(root_mount_point, LOG_DIR)
+        os.makedirs(log_dir, exist_ok=True)
+        return start_variant_prefetch(
+            generate_proxy_strings() + ["nix", "build"] + NIX_FLAGS + [
+                "--store", root_mount_point, "--no-link",
+                variant["toplevel"]] + run.outputs["build-options"],
+            os.path.join(log_dir, "variant-prefetch.log"))
+
+    # ─── Build the system ───────────────────────────────────────
+    def build(run):
+        # This is what nixos-install --flake runs internally, but nixos-install
+        # doesn't pass --log-format through, and we need the structured log
+        # for real progress. nixos-install --system then only activates it.
+        toplevel_ref = "{}#nixosConfigurations.{}.config.system.build.toplevel".format(
+            os.path.join(root_mount_point, "etc/nixos"),
+            hostname
+        )
+
+        build_inputs = [toplevel_ref, run.outputs["install-mode"]["mode"],
+                        file_digest(os.path.join(nixos_dir, "flake.lock"))]
+        # A finished build is only reused while it is still in the target store
+        built = checkpoint.resume(
+            "build", build_inputs,
+            lambda outputs: bool(outputs.get("systemPath")) and os.path.isdir(
+                os.path.join(root_mount_point, outputs["systemPath"].lstrip("/"))),
+            after=["generate", "hardware-rewrite", "flake-lock"])
+        if built:
+            return built["systemPath"]
+
+        cmd = []
+        cmd.extend(generate_proxy_strings())
+        cmd.extend(["nix", "build"] + NIX_FLAGS + [
+            "--log-format", "internal-json", "-v",
+            "--store", root_mount_point,
+            "--no-link", "--print-out-paths",
+            toplevel_ref,
+        ])
+        cmd.extend(run.outputs["build-options"])
+
+        log_dir = os.path.join(root_mount_point, LOG_DIR)
+        os.makedirs(log_dir, exist_ok=True)
+        build_log = os.path.join(log_dir, "nix-build.log.gz")
+        METRICS.extra["installLog"] = "/" + os.path.join(LOG_DIR, "nix-build.log.gz")
+
+        progress = NixProgress()
+        system_path = None
+        build_start = time.monotonic()
+        try:
+            proc = RusagePopen(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True
+            )
+            pump = LogPump(proc.stderr, progress, build_log).start()
+
+            last_summary = time.monotonic()
+            while pump.wait(PROGRESS_INTERVAL):
+                pump.flush("[nix build] ")
+                run.progress(progress.fraction())
+                now = time.monotonic()
+                if now - last_summary >= SUMMARY_INTERVAL:
+                    last_summary = now
+                    libcalamares.utils.debug("[nix build] " + progress.summary())
+            pump.flush("[nix build] ")
+
+            system_path = proc.stdout.read().strip()
+            proc.wait()
+            METRICS.record_command("nix build", cmd, build_start, proc)
+            METRICS.extra["installLogLines"] = pump.lines
+            METRICS.extra["downloadedBytes"] = progress.downloaded
+
+        except Exception as e:
+            raise InstallError("nixos-install failed",
+                               "Error building the system: {}".format(str(e)))
+
+        if proc.returncode != 0 or not system_path:
+            raise InstallError(
+                "nixos-install failed",
+                "Building the system exited with code {}\n\n{}\n\n"
+                "The full log is in {} on the target.".format(
+                    proc.returncode, "\n".join(pump.tail),
+                    METRICS.extra["installLog"]))
+
+        libcalamares.utils.debug("[nix build] " + progress.summary())
+        checkpoint.complete("build", build_inputs,
+                            {"systemPath": system_path})
+        return system_path
+
+    # Weights are each phase's rough share of a typical install
+    METRICS.end_phase()
+    outputs, error = run_tasks([
+        Task("generate", [], 0.04, generate),
+        Task("hardware-config", [], 0.04, hardware_config),
+        Task("hardware-rewrite", ["hardware-config"], 0.04, hardware_rewrite),
+        Task("install-mode", [], 0.02, resolve_mode),
+        Task("flake-lock", ["generate", "install-mode"], 0.05, lock_flake),
+        Task("build-options", ["install-mode"], 0.01, build_options),
+        Task("store-seed", [], 0.05, store_seed),
+        Task("variant-prefetch", ["build-options", "store-seed"], 0,
+             variant_prefetch),
+        Task("build", ["generate", "hardware-rewrite", "flake-lock",
+                       "build-options", "store-seed", "variant-prefetch"],
+             0.75, build),
+    ], lambda fraction: libcalamares.job.setprogress(0.1 + 0.85 * fraction))
+
+    if outputs.get("variant-prefetch"):
+        METRICS.extra["variant"]["prefetch"] = \
+            finish_variant_prefetch(outputs["variant-prefetch"])
+    if error:
+        return error
+    system_path = outputs["build"]
+
+    libcalamares.job.setprogress(0.95)
+
+    # ─── Run nixos-install ──────────────────────────────────────
+    METRICS.phase("nixos-install")
     try:
-        subprocess.run(
-            ["nixos-generate-config", "--root", root_mount_point],
+        result = run_command(
+            "nixos-install",
+            ["nixos-install", "--no-root-passwd",
+             "--root", root_mount_point,
+             "--system", system_path, "--no-channel-copy"],
             check=True, capture_output=True, text=True
         )
+        write_log(root_mount_point, "nixos-install",
+                  result.stdout + result.stderr)
     except subprocess.CalledProcessError as e:
-        return ("Failed to generate hardware config",
-                "nixos-generate-config failed: {}".format(e.stderr))
+        write_log(root_mount_point, "nixos-install", e.stdout + e.stderr)
+        return ("nixos-install failed",
+                "nixos-install exited with code {}\n\n{}".format(
+                    e.returncode, e.stdout + e.stderr))
 
-    # Move hardware-configuration.nix to hosts/<hostname>/hardware.nix
-    hw_source = os.path.join(root_mount_point, "etc/nixos/hardware-configuration.nix")
-    hw_dest = os.path.join(host_hw_dir, "hardware.nix")
-    if os.path.exists(hw_source):
-        shutil.move(hw_source, hw_dest)
+    checkpoint.clear()
 
-    # Remove the generated configuration.nix (we don't need it)
-    gen_config = os.path.join(root_mount_point, "etc/nixos/configuration.nix")
-    if os.path.exists(gen_config):
-        os.remove(gen_config)
+    METRICS.phase("accounting")
+    if outputs["store-seed"]:
+        try:
+            METRICS.extra["storeSeed"]["unused"] = remove_unseeded(
+                root_mount_point, outputs["store-seed"], system_path)
+        except (OSError, subprocess.CalledProcessError) as e:
+            libcalamares.utils.debug(
+                "Cannot remove unused seeded paths: {}".format(e))
+
+    sources = store_path_sources(root_mount_point)
+    if sources:
+        gs.insert("cairn_storePathSources", sources)
+        METRICS.extra["storePathSources"] = sources
+        libcalamares.utils.debug(
+            "Store paths: {} from live medium ({:.1f} MiB), "
+            "{} fetched or built ({:.1f} MiB)".format(
+                sources["local"]["paths"],
+                sources["local"]["bytes"] / 2**20,
+                sources["remote"]["paths"],
+                sources["remote"]["bytes"] / 2**20))
 
-    # Fix btrfs subvolumes if needed
-    fix_btrfs_subvolumes(hw_dest)
+    libcalamares.job.setprogress(1.0)
+    return None
 
-    # Strip unfree kernel packages if unfree is disabled
-    if not allow_unfree:
-        strip_unfree_hw_packages(hw_dest)
 
-    libcalamares.job.setprogress(0.25)
+def run():
+    """Main Calamares job entry point."""
+    gs = libcalamares.globalstorage
+    # The plan instance runs before partitioning, without a target
+    if (libcalamares.job.configuration or {}).get("mode") == "plan":
+        return run_plan(gs)
+
+    root_mount_point = gs.value("rootMountPoint")
 
-    # ─── Lock the flake (requires network) ─────────────────────
-    # nixos-install --flake will resolve inputs, but we lock first
-    # to get a clear error if network is unavailable.
-    libcalamares.utils.debug("Locking flake inputs (this requires network)...")
+    if not root_mount_point:
+        return ("Failed to find mount point",
+                "globalstorage does not contain a rootMountPoint")
+
+    METRICS.reset()
+    METRICS.extra["probeTimings"] = gs.value("cairn_probeTimings") or {}
+    result = None
     try:
-        subprocess.run(
-            ["nix", "flake", "lock",
-             "--extra-experimental-features", "nix-command flakes"],
-            cwd=nixos_dir,
-            check=True, capture_output=True, text=True,
-            timeout=300
-        )
-    except subprocess.TimeoutExpired:
-        return ("Flake lock timed out",
-                "nix flake lock timed out after 5 minutes. "
-                "Check your network connection.")
-    except subprocess.CalledProcessError as e:
-        return ("Failed to lock flake",
-                "nix flake lock failed (is the network available?):\n{}".format(
-                    e.stderr))
+        result = install(gs, root_mount_point)
+        return result
+    finally:
+        report = METRICS.report(result)
+        for line in METRICS.summary():
+            libcalamares.utils.debug(line)
+        write_metrics(root_mount_point, report)
+
+
+# ─── Headless batch mode ──────────────────────────────────────────
+# Answers files hold the globalstorage keys the installer pages would
+# set (hostname, username, locationRegion, cairn_cpuVendor, ...,
+# cairn_hardwareProfile) as JSON or TOML, plus an optional
+# "hardwareConfig" path to the host's hardware-configuration.nix. A
+# directory stands for every answers file in it.
+#
+#   python3 main.py generate -o DIR ANSWERS...   render a multi-host flake
+#   python3 main.py install --root /mnt ANSWERS  install one host
+#   python3 main.py hardware --dry-run FILE      preview hardware.nix rewrites
+#   python3 main.py variants -o INDEX MATRIX     prebuild variants (see above)
+#
+# A variants matrix is an answers file whose list values are the choices
+# to combine, e.g. cairn_gpuVendor = ["amd", "intel", "nvidia"].
 
-    libcalamares.job.setprogress(0.3)
+ANSWERS_SUFFIXES = (".json", ".toml")
 
-    # ─── Run nixos-install ──────────────────────────────────────
-    flake_ref = "{}#{}".format(
-        os.path.join(root_mount_point, "etc/nixos"),
-        hostname
+
+def load_answers(path):
+    """Read one answers file (JSON, or TOML with Python 3.11+)."""
+    if path.endswith(".toml"):
+        try:
+            import tomllib
+        except ImportError:
+            raise ValueError("{}: TOML answers need Python 3.11 or "
+                             "later".format(path))
+        with open(path, "rb") as f:
+            return tomllib.load(f)
+    with open(path) as f:
+        return json.load(f)
+
+
+def expand_answers(paths):
+    """Expand directories in paths to the answers files they contain."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(
+                os.path.join(path, name) for name in os.listdir(path)
+                if name.endswith(ANSWERS_SUFFIXES)))
+        else:
+            files.append(path)
+    return files
+
+
+class AnswersStorage:
+    """globalstorage stand-in backed by an answers dict."""
+
+    def __init__(self, answers):
+        self._data = dict(answers)
+
+    def value(self, key):
+        return self._data.get(key)
+
+    def contains(self, key):
+        return key in self._data
+
+    def insert(self, key, value):
+        self._data[key] = value
+
+
+def headless_runtime(gs, configuration, verbose=True):
+    """The parts of libcalamares this job uses, for running outside it."""
+    def debug(message):
+        if verbose:
+            print(message, file=sys.stderr)
+
+    return types.SimpleNamespace(
+        globalstorage=gs,
+        job=types.SimpleNamespace(
+            configuration=configuration,
+            working_path=os.path.abspath(__file__),
+            setprogress=lambda fraction: None,
+        ),
+        utils=types.SimpleNamespace(debug=debug),
     )
 
-    cmd = []
-    cmd.extend(generate_proxy_strings())
-    cmd.extend([
-        "nixos-install",
-        "--no-root-passwd",
-        "--root", root_mount_point,
-        "--flake", flake_ref,
-        "--option", "build-dir", "/nix/var/nix/builds",
-    ])
 
-    try:
-        proc = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True
-        )
+def _render_fleet_host(nixos_dir, host):
+    unresolved = set()
+    host_hw_dir = write_host(nixos_dir, host["variables"], unresolved)
+    if host["answers"].get("cairn_hardwareProfile"):
+        write_hardware_profile(
+            host_hw_dir, host["answers"]["cairn_hardwareProfile"])
+    hw_config = host["answers"].get("hardwareConfig")
+    if hw_config:
+        hw_dest = os.path.join(host_hw_dir, "hardware.nix")
+        shutil.copy(hw_config, hw_dest)
+        rewrite_hardware_config(hw_dest, {
+            "allowUnfree": host["answers"].get("nixos_allow_unfree"),
+            "unfreeCache": host["answers"].get("unfreeCache"),
+        })
+    return unresolved
+
+
+def generate_fleet(answer_files, nixos_dir, jobs=None):
+    """
+    Render a flake with one host per answers file into nixos_dir.
+    Returns a list of problems; the flake is only complete if it's empty.
+    """
+    problems = []
+    hosts = []
+    users = {}
+    for path in answer_files:
+        try:
+            answers = load_answers(path)
+        except (OSError, ValueError) as e:
+            problems.append("{}: {}".format(path, e))
+            continue
+        variables = build_variables(answers.get)
+        missing = [key for key in ("hostname", "username", "timezone")
+                   if key not in variables]
+        if missing:
+            problems.append("{}: missing {}".format(path, ", ".join(missing)))
+            continue
+        if any(h["variables"]["hostname"] == variables["hostname"]
+               for h in hosts):
+            problems.append("{}: duplicate hostname {}".format(
+                path, variables["hostname"]))
+            continue
+        # Hosts share users/<name>.nix, so they must agree on its content
+        user_file = render(cfg_user, variables)
+        username = variables["username"]
+        if users.setdefault(username, (path, user_file))[1] != user_file:
+            problems.append("{}: user {} differs from {}".format(
+                path, username, users[username][0]))
+            continue
+        hosts.append({"path": path, "answers": answers,
+                      "variables": variables})
+
+    if not hosts:
+        return problems or ["No answers files given"]
+
+    os.makedirs(nixos_dir, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        results = pool.map(
+            lambda host: _render_fleet_host(nixos_dir, host), hosts)
+        for host, unresolved in zip(hosts, results):
+            if unresolved:
+                problems.append("{}: no value for {}".format(
+                    host["path"], ", ".join(sorted(unresolved))))
+            if not host["answers"].get("hardwareConfig"):
+                problems.append("{}: add hosts/{}/hardware.nix before "
+                                "building".format(
+                                    host["path"],
+                                    host["variables"]["hostname"]))
+
+    hostnames = sorted(h["variables"]["hostname"] for h in hosts)
+    with open(os.path.join(nixos_dir, "flake.nix"), "w") as f:
+        f.write(render(cfg_flake, flake_variables(hostnames)))
+    return problems
 
-        # Stream output for progress, keep last lines for error reporting
-        last_lines = []
-        for line in proc.stdout:
-            stripped = line.rstrip()
-            libcalamares.utils.debug("[nixos-install] " + stripped)
-            last_lines.append(stripped)
-            if len(last_lines) > 50:
-                last_lines.pop(0)
 
-        proc.wait()
+def expand_matrix(matrix):
+    """Every answers dict a variants matrix combines."""
+    keys = sorted(k for k, v in matrix.items() if isinstance(v, list))
+    fixed = {k: v for k, v in matrix.items() if k not in keys}
+    for combination in itertools.product(*(matrix[k] for k in keys)):
+        answers = dict(SPECULATIVE_ANSWERS, hostname="cairn-variant")
+        answers.update(fixed)
+        answers.update(zip(keys, combination))
+        yield answers
 
-        if proc.returncode != 0:
-            tail = "\n".join(last_lines[-30:])
-            return ("nixos-install failed",
-                    "nixos-install exited with code {}\n\n{}".format(
-                        proc.returncode, tail))
 
-    except Exception as e:
-        return ("nixos-install failed",
-                "Error running nixos-install: {}".format(str(e)))
+def build_variants(matrix, index_path, work_dir, pin=None):
+    """
+    Render, lock and build each distinct variant in matrix under
+    work_dir (the result links keep the toplevels alive) and write the
+    index to index_path. Returns (toplevels, problems).
+    """
+    index = {"version": VARIANTS_VERSION, "variants": {}}
+    if pin:
+        index["rev"] = pin["rev"]
+    lock_file = None
+    problems = []
+    for answers in expand_matrix(matrix):
+        variables = build_variables(answers.get)
+        key = variant_key(variables)
+        if key in index["variants"]:
+            continue
+        variant_dir = os.path.join(work_dir, key[:12])
+        host_hw_dir = write_flake(variant_dir, variables)
+        with open(os.path.join(host_hw_dir, "hardware.nix"), "w") as f:
+            f.write(speculative_hardware)
 
-    libcalamares.job.setprogress(1.0)
-    return None
+        try:
+            # Every variant has the same inputs, so lock them once
+            if lock_file:
+                shutil.copy(lock_file, os.path.join(variant_dir, "flake.lock"))
+            else:
+                run_command("nix flake lock", flake_lock_command("online", pin),
+                            cwd=variant_dir, check=True,
+                            capture_output=True, text=True)
+                lock_file = os.path.join(variant_dir, "flake.lock")
+            result = run_command(
+                "nix build",
+                ["nix", "build"] + NIX_FLAGS + [
+                    "--out-link", os.path.join(variant_dir, "result"),
+                    "--print-out-paths",
+                    "{}#nixosConfigurations.{}.config.system.build.toplevel"
+                    .format(variant_dir, variables["hostname"])],
+                check=True, capture_output=True, text=True)
+        except (OSError, subprocess.CalledProcessError) as e:
+            problems.append("{}: {}".format(
+                json.dumps(variant_choices(variables), sort_keys=True),
+                getattr(e, "stderr", None) or e))
+            continue
+        index["variants"][key] = {
+            "toplevel": result.stdout.strip(),
+            "choices": variant_choices(variables),
+        }
+        libcalamares.utils.debug("Built variant {}: {}".format(
+            key[:12], index["variants"][key]["toplevel"]))
+
+    write_atomic(index_path, json.dumps(index, indent=2, sort_keys=True) + "\n")
+    return [v["toplevel"] for v in index["variants"].values()], problems
+
+
+def main(argv=None):
+    """Headless entry point; see the section comment above."""
+    import argparse
+
+    global libcalamares
+
+    parser = argparse.ArgumentParser(
+        description="Generate or install Cairn hosts from answers files.")
+    parser.add_argument("-q", "--quiet", action="store_true")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    generate = commands.add_parser(
+        "generate", help="render a multi-host flake")
+    generate.add_argument("-o", "--output", default="nixos")
+    generate.add_argument("-j", "--jobs", type=int, default=None)
+    generate.add_argument("answers", nargs="+",
+                          help="answers files or directories of them")
+
+    install_cmd = commands.add_parser(
+        "install", help="install one host to a mounted target")
+    install_cmd.add_argument("--root", required=True,
+                             help="target root mount point")
+    install_cmd.add_argument("--mode", default="auto",
+                             choices=("online", "offline", "auto"))
+    install_cmd.add_argument("--unfree-cache", default=DEFAULT_UNFREE_CACHE)
+    install_cmd.add_argument("--source-pin", default=DEFAULT_SOURCE_PIN)
+    install_cmd.add_argument("--fresh", action="store_true",
+                             help="ignore the checkpoint of a failed install")
+    install_cmd.add_argument("--substituter", action="append", default=[],
+                             metavar="URL", help="binary cache to try "
+                             "alongside the defaults, e.g. a LAN mirror")
+    install_cmd.add_argument("--trusted-public-key", action="append",
+                             default=[], metavar="KEY")
+    install_cmd.add_argument("answers")
+
+    hardware = commands.add_parser(
+        "hardware", help="apply the hardware.nix rewrites to a file")
+    hardware.add_argument("--dry-run", action="store_true",
+                          help="print a diff instead of writing")
+    hardware.add_argument("--allow-unfree", action="store_true")
+    hardware.add_argument("--unfree-cache", default=DEFAULT_UNFREE_CACHE)
+    hardware.add_argument("path")
+
+    variants = commands.add_parser(
+        "variants", help="prebuild common configurations and index them")
+    variants.add_argument("-o", "--output", default="variants.json",
+                          help="index to write")
+    variants.add_argument("-w", "--work-dir", default="variants",
+                          help="where variant flakes and result links go")
+    variants.add_argument("--source-pin", default=None,
+                          help="pin cairn as the ISO will (source.json)")
+    variants.add_argument("matrix")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "hardware":
+        libcalamares = headless_runtime(
+            AnswersStorage({}), {}, verbose=not args.quiet)
+        diff = rewrite_hardware_config(args.path, {
+            "allowUnfree": args.allow_unfree,
+            "unfreeCache": args.unfree_cache,
+        }, dry_run=args.dry_run)
+        sys.stdout.write(diff)
+        return 0
+
+    if args.command == "variants":
+        libcalamares = headless_runtime(
+            AnswersStorage({}), {}, verbose=not args.quiet)
+        pin = load_source_pin(args.source_pin) if args.source_pin else None
+        toplevels, problems = build_variants(
+            load_answers(args.matrix), args.output, args.work_dir, pin)
+        # One per line, for piping into e.g. cachix push
+        for toplevel in toplevels:
+            print(toplevel)
+        for problem in problems:
+            print(problem, file=sys.stderr)
+        return 1 if problems else 0
+
+    if args.command == "generate":
+        libcalamares = headless_runtime(
+            AnswersStorage({}), {}, verbose=not args.quiet)
+        problems = generate_fleet(
+            expand_answers(args.answers), args.output, args.jobs)
+        for problem in problems:
+            print(problem, file=sys.stderr)
+        return 1 if problems else 0
+
+    answers = load_answers(args.answers)
+    answers["rootMountPoint"] = args.root
+    libcalamares = headless_runtime(AnswersStorage(answers), {
+        "installMode": args.mode,
+        "unfreeCache": args.unfree_cache,
+        "sourcePin": args.source_pin,
+        "resume": not args.fresh,
+        "substituters": args.substituter + DEFAULT_SUBSTITUTERS,
+        "trustedPublicKeys": args.trusted_public_key,
+    }, verbose=not args.quiet)
+    result = run()
+    if result is not None:
+        print("{}: {}".format(*result), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,28 +6,205 @@
 # Runs before the show phase to populate globalstorage with detected
 # hardware values. The cairnconfig QML page reads these as defaults.
 
-import glob
+import importlib.util
+import json
 import os
 import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from datetime import datetime, timezone
 
 import libcalamares
 
 
-def detect_cpu():
-    """Detect CPU vendor from /proc/cpuinfo."""
+PROC_ROOT = "/proc"
+SYSFS_ROOT = "/sys"
+
+
+def _read_sysfs(path):
+    """Read a sysfs attribute, returning None if it can't be read."""
     try:
-        with open("/proc/cpuinfo", "r") as f:
-            content = f.read()
-        if "GenuineIntel" in content:
-            return "intel"
-        elif "AuthenticAMD" in content:
-            return "amd"
+        with open(path, "r") as f:
+            return f.read().strip()
     except OSError:
+        return None
+
+
+def _read_sysfs_hex(path):
+    """Read a hex-valued sysfs attribute (e.g. 0x10de) as an int, or None."""
+    value = _read_sysfs(path)
+    if value is None:
+        return None
+    try:
+        return int(value, 16)
+    except ValueError:
+        return None
+
+
+CPU_VENDORS = {
+    "GenuineIntel": "intel",
+    "AuthenticAMD": "amd",
+}
+
+# x86-64 psABI micro-architecture levels and the /proc/cpuinfo flags
+# each one adds over the previous level (lzcnt is reported as "abm",
+# sse3 as "pni").
+X86_64_LEVELS = [
+    ("v2", {"cx16", "lahf_lm", "popcnt", "pni", "ssse3", "sse4_1", "sse4_2"}),
+    ("v3", {"abm", "avx", "avx2", "bmi1", "bmi2", "f16c", "fma", "movbe",
+            "xsave"}),
+    ("v4", {"avx512f", "avx512bw", "avx512cd", "avx512dq", "avx512vl"}),
+]
+
+# cpuinfo keys we need; parsing stops once the first processor block ends
+CPUINFO_KEYS = ("vendor_id", "model name", "flags", "siblings", "cpu cores")
+
+
+def parse_cpuinfo(path):
+    """
+    Stream /proc/cpuinfo and return the wanted keys of the first processor
+    block. Every block carries the same vendor, flags and per-package
+    topology, so there is no need to read the other hundreds of KB on
+    large machines.
+    """
+    info = {}
+    with open(path, "r") as f:
+        for line in f:
+            if not line.strip():
+                if info:
+                    break
+                continue
+            key, _, value = line.partition(":")
+            key = key.strip()
+            if key in CPUINFO_KEYS:
+                info[key] = value.strip()
+    return info
+
+
+def x86_64_level(flags):
+    """Return the highest x86-64 psABI level ("v1".."v4") supported by flags."""
+    level = "v1"
+    for name, required in X86_64_LEVELS:
+        if not required <= flags:
+            break
+        level = name
+    return level
+
+
+def count_online_cpus(sysfs_root=SYSFS_ROOT):
+    """Count online logical CPUs from the sysfs cpu list (e.g. "0-63,128-191")."""
+    online = _read_sysfs(os.path.join(sysfs_root, "devices/system/cpu/online"))
+    if not online:
+        return os.cpu_count() or 0
+    count = 0
+    for part in online.split(","):
+        first, _, last = part.partition("-")
+        count += int(last or first) - int(first) + 1
+    return count
+
+
+def detect_cpufreq_driver(sysfs_root=SYSFS_ROOT):
+    """Read the active cpufreq scaling driver (amd-pstate-epp, intel_pstate, ...)."""
+    return _read_sysfs(os.path.join(
+        sysfs_root, "devices/system/cpu/cpu0/cpufreq/scaling_driver")) or ""
+
+
+def detect_cpu(proc_root=PROC_ROOT, sysfs_root=SYSFS_ROOT):
+    """
+    Detect CPU vendor, topology, x86-64 level and cpufreq driver.
+
+    Returns a dict with keys vendor ("intel"/"amd"/""), model, threads,
+    cores, x86_64Level ("" on non-x86 or unreadable flags) and
+    cpufreqDriver.
+    """
+    try:
+        info = parse_cpuinfo(os.path.join(proc_root, "cpuinfo"))
+    except OSError:
+        info = {}
+
+    threads = count_online_cpus(sysfs_root)
+    cores = threads
+    try:
+        siblings = int(info["siblings"])
+        cpu_cores = int(info["cpu cores"])
+        if siblings > 0:
+            cores = threads * cpu_cores // siblings
+    except (KeyError, ValueError):
         pass
-    return ""
 
+    flags = set(info.get("flags", "").split())
+    level = x86_64_level(flags) if "lm" in flags else ""
+
+    return {
+        "vendor": CPU_VENDORS.get(info.get("vendor_id"), ""),
+        "model": info.get("model name", ""),
+        "threads": threads,
+        "cores": cores,
+        "x86_64Level": level,
+        "cpufreqDriver": detect_cpufreq_driver(sysfs_root),
+    }
 
-def detect_gpu():
+
+# PCI vendor IDs of display controllers the graphics module can configure
+PCI_VENDORS = {
+    0x10de: "nvidia",
+    0x1002: "amd",
+    0x8086: "intel",
+}
+
+# PCI base class 0x03: display controller (VGA 0x0300, 3D 0x0302, other 0x0380)
+PCI_CLASS_DISPLAY = 0x03
+
+
+def pci_bus_id(slot):
+    """
+    Convert a sysfs PCI address (0000:01:00.0, hex) to the decimal bus ID
+    form Xorg and the NixOS prime options use (PCI:1:0:0).
+    """
+    domain, bus, devfn = slot.split(":")
+    device, function = devfn.split(".")
+    domain, bus, device, function = (int(x, 16) for x in
+                                     (domain, bus, device, function))
+    if domain:
+        return "PCI:{}@{}:{}:{}".format(bus, domain, device, function)
+    return "PCI:{}:{}:{}".format(bus, device, function)
+
+
+def scan_pci_display(sysfs_root=SYSFS_ROOT):
+    """
+    Scan <sysfs_root>/bus/pci/devices for display controllers.
+
+    Returns a list of dicts in PCI slot order with keys slot, busId,
+    class, vendor, device (ints for the last three), vendorName ("" if
+    the vendor isn't one we configure) and bootVga. Returns None if the PCI
+    device tree can't be read at all, so callers can fall back to lspci.
+    """
+    base = os.path.join(sysfs_root, "bus/pci/devices")
+    try:
+        slots = sorted(os.listdir(base))
+    except OSError:
+        return None
+
+    devices = []
+    for slot in slots:
+        dev = os.path.join(base, slot)
+        pci_class = _read_sysfs_hex(os.path.join(dev, "class"))
+        if pci_class is None or (pci_class >> 16) != PCI_CLASS_DISPLAY:
+            continue
+        vendor = _read_sysfs_hex(os.path.join(dev, "vendor"))
+        devices.append({
+            "slot": slot,
+            "busId": pci_bus_id(slot),
+            "class": pci_class,
+            "vendor": vendor,
+            "device": _read_sysfs_hex(os.path.join(dev, "device")),
+            "vendorName": PCI_VENDORS.get(vendor, ""),
+            "bootVga": _read_sysfs(os.path.join(dev, "boot_vga")) == "1",
+        })
+    return devices
+
+
+def _detect_gpu_lspci():
     """Detect GPU vendor from lspci VGA output."""
     try:
         result = subprocess.run(
@@ -48,55 +225,434 @@ def detect_gpu():
     return ""
 
 
-def detect_form_factor():
+def primary_gpu_vendor(devices):
+    """Vendor of the boot VGA device, else the first one we configure."""
+    known = [d for d in devices if d["vendorName"]]
+    for dev in known:
+        if dev["bootVga"]:
+            return dev["vendorName"]
+    if known:
+        return known[0]["vendorName"]
+    return ""
+
+
+# cairn.hardware.prime option naming the integrated GPU, by vendor
+PRIME_IGPU_KEYS = {"intel": "intelBusId", "amd": "amdgpuBusId"}
+
+
+def detect_prime(devices):
+    """
+    Detect an NVIDIA dGPU paired with an Intel/AMD iGPU that drives the
+    display (the boot VGA device). Returns the cairn.hardware.prime bus
+    IDs, or None when there's no such pair or the NVIDIA GPU has the
+    display, in which case render offload doesn't apply.
+    """
+    nvidia = [d for d in devices if d["vendorName"] == "nvidia"]
+    integrated = [d for d in devices if d["vendorName"] in PRIME_IGPU_KEYS]
+    if not nvidia or not integrated:
+        return None
+    if any(d["bootVga"] for d in nvidia):
+        return None
+    igpu = next((d for d in integrated if d["bootVga"]), integrated[0])
+    return {
+        "nvidiaBusId": nvidia[0]["busId"],
+        PRIME_IGPU_KEYS[igpu["vendorName"]]: igpu["busId"],
+    }
+
+
+def detect_gpus(sysfs_root=SYSFS_ROOT):
+    """
+    Detect display controllers from the sysfs PCI device tree.
+    Returns {"vendor", "devices": scan_pci_display(), "prime"}. Hybrid
+    laptops report vendor "nvidia" with prime bus IDs, so the dGPU gets
+    its driver while the iGPU keeps the display. Falls back to lspci,
+    with no device list, only if sysfs can't be read.
+    """
+    devices = scan_pci_display(sysfs_root)
+    if devices is None:
+        return {"vendor": _detect_gpu_lspci(), "devices": [], "prime": None}
+    prime = detect_prime(devices)
+    return {
+        "vendor": "nvidia" if prime else primary_gpu_vendor(devices),
+        "devices": devices,
+        "prime": prime,
+    }
+
+
+def detect_gpu(sysfs_root=SYSFS_ROOT):
+    """Detect the GPU vendor to configure drivers for."""
+    return detect_gpus(sysfs_root)["vendor"]
+
+
+def detect_batteries(sysfs_root=SYSFS_ROOT):
+    """
+    List system batteries from <sysfs_root>/class/power_supply, skipping
+    peripheral ones (wireless mice etc. report scope "Device").
+    Capacities are in Wh, None where the battery doesn't report energy.
+    """
+    power_supply = os.path.join(sysfs_root, "class/power_supply")
+    try:
+        names = sorted(os.listdir(power_supply))
+    except OSError:
+        return []
+
+    batteries = []
+    for name in names:
+        supply = os.path.join(power_supply, name)
+        if _read_sysfs(os.path.join(supply, "type")) != "Battery":
+            continue
+        if _read_sysfs(os.path.join(supply, "scope")) == "Device":
+            continue
+        battery = {"name": name}
+        for key, attr in (("manufacturer", "manufacturer"),
+                          ("model", "model_name"),
+                          ("technology", "technology")):
+            battery[key] = _read_sysfs(os.path.join(supply, attr)) or ""
+        for key, attr in (("designWh", "energy_full_design"),
+                          ("fullWh", "energy_full")):
+            value = _read_sysfs(os.path.join(supply, attr))
+            battery[key] = (round(int(value) / 1e6, 1)
+                            if value and value.isdigit() else None)
+        batteries.append(battery)
+    return batteries
+
+
+def detect_form_factor(sysfs_root=SYSFS_ROOT):
     """Detect form factor from battery presence."""
-    # Check for BAT* entries in power_supply
-    bat_paths = glob.glob("/sys/class/power_supply/BAT*")
-    if bat_paths:
-        return "laptop"
+    return "laptop" if detect_batteries(sysfs_root) else "desktop"
 
-    # Also check for a generic "battery" entry
-    if os.path.isdir("/sys/class/power_supply/battery"):
-        return "laptop"
 
-    return "desktop"
+# Block devices that are not disks the system could be installed on
+VIRTUAL_BLOCK_PREFIXES = ("loop", "ram", "zram", "dm-", "md", "sr", "nbd")
 
 
-def detect_ssd():
-    """Detect SSD presence from block device rotational flag."""
+def detect_disks(sysfs_root=SYSFS_ROOT):
+    """
+    List physical block devices from <sysfs_root>/block with keys name,
+    sizeBytes, rotational, removable and model.
+    """
+    block = os.path.join(sysfs_root, "block")
     try:
-        for entry in os.listdir("/sys/block"):
-            rotational_path = "/sys/block/{}/queue/rotational".format(entry)
-            if os.path.exists(rotational_path):
-                with open(rotational_path, "r") as f:
-                    if f.read().strip() == "0":
-                        return True
+        names = sorted(os.listdir(block))
     except OSError:
+        return []
+
+    disks = []
+    for name in names:
+        if name.startswith(VIRTUAL_BLOCK_PREFIXES):
+            continue
+        dev = os.path.join(block, name)
+        sectors = _read_sysfs(os.path.join(dev, "size"))
+        disks.append({
+            "name": name,
+            # sysfs sizes are in 512-byte sectors regardless of block size
+            "sizeBytes": int(sectors) * 512 if sectors and sectors.isdigit() else None,
+            "rotational": _read_sysfs(os.path.join(dev, "queue/rotational")) != "0",
+            "removable": _read_sysfs(os.path.join(dev, "removable")) == "1",
+            "model": _read_sysfs(os.path.join(dev, "device/model")) or "",
+        })
+    return disks
+
+
+def has_ssd(disks):
+    """Whether any fixed disk is non-rotational (SSD or NVMe)."""
+    return any(not d["rotational"] and not d["removable"] for d in disks)
+
+
+def detect_ssd(sysfs_root=SYSFS_ROOT):
+    """Detect SSD presence from block device rotational flag."""
+    return has_ssd(detect_disks(sysfs_root))
+
+
+def detect_memory(proc_root=PROC_ROOT):
+    """Installed RAM and configured swap in bytes, from /proc/meminfo."""
+    memory = {}
+    keys = {"MemTotal": "totalBytes", "SwapTotal": "swapBytes"}
+    try:
+        with open(os.path.join(proc_root, "meminfo"), "r") as f:
+            for line in f:
+                key, _, rest = line.partition(":")
+                if key in keys:
+                    memory[keys[key]] = int(rest.split()[0]) * 1024
+                    if len(memory) == len(keys):
+                        break
+    except (OSError, ValueError, IndexError):
         pass
-    return False
+    return memory
+
+
+# DMI identification worth keeping; serial numbers are left out on purpose
+DMI_KEYS = {
+    "vendor": "sys_vendor",
+    "product": "product_name",
+    "version": "product_version",
+    "boardVendor": "board_vendor",
+    "boardName": "board_name",
+    "biosVendor": "bios_vendor",
+    "biosVersion": "bios_version",
+    "biosDate": "bios_date",
+}
+
+
+def detect_firmware(sysfs_root=SYSFS_ROOT):
+    """
+    Detect the boot firmware (UEFI or BIOS, and EFI bitness) and the DMI
+    system identification.
+    """
+    efi = os.path.join(sysfs_root, "firmware/efi")
+    firmware = {"mode": "uefi" if os.path.isdir(efi) else "bios"}
+    bits = _read_sysfs(os.path.join(efi, "fw_platform_size"))
+    if bits and bits.isdigit():
+        firmware["efiBits"] = int(bits)
+
+    dmi = os.path.join(sysfs_root, "class/dmi/id")
+    for key, attr in DMI_KEYS.items():
+        value = _read_sysfs(os.path.join(dmi, attr))
+        if value:
+            firmware[key] = value
+    chassis = _read_sysfs(os.path.join(dmi, "chassis_type"))
+    if chassis and chassis.isdigit():
+        firmware["chassisType"] = int(chassis)
+    return firmware
+
+
+# ─── Flake input prefetch ─────────────────────────────────────────
+# Runs detached from the job so it keeps going through the show phase.
+# The cairn job finds it through the cairn_prefetch globalstorage key
+# and waits for <dir>/status (the exit code of nix flake archive).
+
+PREFETCH_DIR = "/run/cairn-installer/prefetch"
+DEFAULT_FLAKE_REF = "github:kcalvelli/cairn"
+DEFAULT_SOURCE_PIN = "/etc/cairn-installer/source.json"
+
+PREFETCH_SCRIPT = """\
+nix --extra-experimental-features "nix-command flakes" \\
+  flake archive --json "$1" > "$2/archive.json" 2> "$2/log"
+echo $? > "$2/status.tmp" && mv "$2/status.tmp" "$2/status"
+"""
+
+
+def prefetch_ref(config):
+    """Pick the flake ref to prefetch: the ISO's pinned revision if any."""
+    flake_ref = config.get("flakeRef") or DEFAULT_FLAKE_REF
+    try:
+        with open(config.get("sourcePin") or DEFAULT_SOURCE_PIN, "r") as f:
+            pin = json.load(f)
+        return "{}/{}?narHash={}&lastModified={}".format(
+            flake_ref, pin["rev"], pin["narHash"], pin["lastModified"])
+    except (OSError, ValueError, KeyError):
+        return flake_ref
+
+
+def start_prefetch(flake_ref, state_dir=PREFETCH_DIR):
+    """
+    Start nix flake archive for flake_ref in the background.
+    Returns the state to record in globalstorage, or None if it
+    couldn't be started.
+    """
+    try:
+        os.makedirs(state_dir, exist_ok=True)
+        for name in ("status", "status.tmp", "archive.json", "log"):
+            path = os.path.join(state_dir, name)
+            if os.path.exists(path):
+                os.remove(path)
+        proc = subprocess.Popen(
+            ["sh", "-c", PREFETCH_SCRIPT, "sh", flake_ref, state_dir],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+    except OSError as e:
+        libcalamares.utils.debug(
+            "cairndetect: could not start prefetch: {}".format(e))
+        return None
+    return {
+        "dir": state_dir,
+        "pid": proc.pid,
+        "ref": flake_ref,
+        "started": time.time(),
+    }
+
+
+def load_cairn_job():
+    """Load the cairn job module, which owns the configuration templates."""
+    path = os.path.join(libcalamares.job.working_path, os.pardir,
+                        "cairn", "main.py")
+    spec = importlib.util.spec_from_file_location("cairn_job", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# ─── Probe scheduling ─────────────────────────────────────────────
+# Each probe is (name, function, deadline in seconds, fallback value).
+# Probes run concurrently; one that overruns its deadline or raises is
+# recorded with its fallback so the welcome page is never held up.
+
+PROBES = [
+    ("cpu", detect_cpu, 2.0, {}),
+    ("gpus", detect_gpus, 5.0, {"vendor": "", "devices": [], "prime": None}),
+    ("disks", detect_disks, 2.0, []),
+    ("memory", detect_memory, 2.0, {}),
+    ("batteries", detect_batteries, 2.0, []),
+    ("firmware", detect_firmware, 2.0, {}),
+]
+
+MAX_WORKERS = len(PROBES)
+
+
+# ─── Hardware profile ─────────────────────────────────────────────
+# Everything the probes found, stored once as cairn_hardwareProfile.
+# The cairn job reads it instead of probing again and writes it to
+# hosts/<hostname>/hardware-profile.json on the target.
+
+PROFILE_VERSION = 1
+
+
+def build_profile(results):
+    """Assemble the hardware profile from run_probes() results."""
+    gpus = results["gpus"]
+    return {
+        "version": PROFILE_VERSION,
+        "detectedAt": datetime.now(timezone.utc).isoformat(),
+        "cpu": results["cpu"],
+        "gpu": gpus,
+        "disks": results["disks"],
+        "memory": results["memory"],
+        "batteries": results["batteries"],
+        "firmware": results["firmware"],
+        "formFactor": "laptop" if results["batteries"] else "desktop",
+        "hasSSD": has_ssd(results["disks"]),
+    }
+
+
+def _timed(func):
+    """Call func and return (value, elapsed seconds)."""
+    start = time.monotonic()
+    value = func()
+    return value, time.monotonic() - start
+
+
+def run_probes(probes):
+    """
+    Run probes on a small worker pool, each bounded by its own deadline.
+    Returns (results, timings): results maps probe name to value, timings
+    maps probe name to {"ms": float, "status": "ok"|"timeout"|"error"}.
+    """
+    results = {}
+    timings = {}
+
+    pool = ThreadPoolExecutor(max_workers=MAX_WORKERS,
+                              thread_name_prefix="cairndetect")
+    start = time.monotonic()
+    futures = {name: pool.submit(_timed, func) for name, func, _, _ in probes}
+
+    for name, _, deadline, fallback in probes:
+        remaining = max(deadline - (time.monotonic() - start), 0)
+        try:
+            value, elapsed = futures[name].result(timeout=remaining)
+            results[name] = value
+            timings[name] = {"ms": round(elapsed * 1000, 1), "status": "ok"}
+        except TimeoutError:
+            results[name] = fallback
+            timings[name] = {"ms": round(deadline * 1000, 1),
+                             "status": "timeout"}
+        except Exception as e:
+            results[name] = fallback
+            timings[name] = {
+                "ms": round((time.monotonic() - start) * 1000, 1),
+                "status": "error",
+            }
+            libcalamares.utils.debug(
+                "cairndetect: probe {} failed: {}".format(name, e))
+
+    # Don't wait for stragglers; they finish (or time out) on their own.
+    pool.shutdown(wait=False, cancel_futures=True)
+
+    return results, timings
 
 
 def run():
     """Main Calamares job entry point."""
     gs = libcalamares.globalstorage
+    config = libcalamares.job.configuration or {}
+
+    # Start the prefetch first; it has the whole show phase to finish
+    if config.get("prefetch", True):
+        prefetch = start_prefetch(prefetch_ref(config))
+        if prefetch:
+            gs.insert("cairn_prefetch", prefetch)
+            libcalamares.utils.debug(
+                "cairndetect: prefetching {} (pid {})".format(
+                    prefetch["ref"], prefetch["pid"]))
 
-    cpu = detect_cpu()
-    gpu = detect_gpu()
-    form_factor = detect_form_factor()
-    has_ssd = detect_ssd()
+    results, timings = run_probes(PROBES)
+    profile = build_profile(results)
+    gs.insert("cairn_hardwareProfile", profile)
+
+    # Scalar views of the profile, read by the cairnconfig page
+    cpu_info = profile["cpu"]
+    cpu = cpu_info.get("vendor", "")
+    gpu = profile["gpu"]["vendor"]
+    form_factor = profile["formFactor"]
+    ssd = profile["hasSSD"]
 
     if cpu:
         gs.insert("cairn_cpuVendor", cpu)
     if gpu:
         gs.insert("cairn_gpuVendor", gpu)
 
+    if cpu_info.get("threads"):
+        gs.insert("cairn_cpuThreads", cpu_info["threads"])
+        gs.insert("cairn_cpuCores", cpu_info["cores"])
+    if cpu_info.get("x86_64Level"):
+        gs.insert("cairn_cpuLevel", cpu_info["x86_64Level"])
+    if cpu_info.get("cpufreqDriver"):
+        gs.insert("cairn_cpufreqDriver", cpu_info["cpufreqDriver"])
+
     gs.insert("cairn_formFactor", form_factor)
-    gs.insert("cairn_hasSSD", has_ssd)
+    gs.insert("cairn_hasSSD", ssd)
+    gs.insert("cairn_probeTimings", timings)
 
     libcalamares.utils.debug(
-        "cairndetect: cpu={}, gpu={}, formFactor={}, hasSSD={}".format(
-            cpu or "unknown", gpu or "unknown", form_factor, has_ssd
+        "cairndetect: cpu={} ({}c/{}t, x86-64-{}, {}), gpu={}, "
+        "formFactor={}, hasSSD={}".format(
+            cpu or "unknown", cpu_info.get("cores", "?"),
+            cpu_info.get("threads", "?"),
+            cpu_info.get("x86_64Level") or "unknown",
+            cpu_info.get("cpufreqDriver") or "no cpufreq",
+            gpu or "unknown", form_factor, ssd
         )
     )
+    libcalamares.utils.debug(
+        "cairndetect: {} GPU(s), {} disk(s), {:.1f} GiB RAM, {} batteries, "
+        "{} firmware".format(
+            len(profile["gpu"]["devices"]), len(profile["disks"]),
+            profile["memory"].get("totalBytes", 0) / 2**30,
+            len(profile["batteries"]), profile["firmware"].get("mode", "?")))
+    libcalamares.utils.debug(
+        "cairndetect: probe timings: {}".format(", ".join(
+            "{}={}ms ({})".format(name, t["ms"], t["status"])
+            for name, t in timings.items()
+        ))
+    )
+
+    # Speculatively build the most likely system now that the hardware
+    # is known; the cairn job cancels it if the answers diverge
+    if config.get("speculativeBuild", False):
+        try:
+            speculative = load_cairn_job().start_speculative_build(
+                gs.value,
+                ["--override-input", "cairn", prefetch_ref(config)])
+        except Exception as e:
+            speculative = None
+            libcalamares.utils.debug(
+                "cairndetect: speculative build unavailable: {}".format(e))
+        if speculative:
+            gs.insert("cairn_speculative", speculative)
+            libcalamares.utils.debug(
+                "cairndetect: speculative build started (pid {})".format(
+                    speculative["pid"]))
 
     return None